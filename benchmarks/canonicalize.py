@@ -0,0 +1,52 @@
+"""
+Benchmark Canonicalize on texts with many search results. Time taken should
+grow about linearly with the number of results.
+
+    poetry run python benchmarks/canonicalize.py
+"""
+
+import random
+
+from lute.benchmark import patch_graph
+from lute.graph import Graph
+from lute.node import Variable
+from lute.node.search.generic import Canonicalize
+
+
+def make_input(n_results: int, rng: random.Random):
+    text = " ".join(rng.choice(["hola", "planet", "earth", "world", "x"]) for _ in range(n_results))
+
+    searches = []
+    for _ in range(n_results):
+        start = rng.randrange(len(text) - 20)
+        searches.append({
+            "type": "expansion",
+            "value": rng.choice(["hello", "world", "planet"]),
+            "range": (start, start + rng.randrange(1, 20))
+        })
+
+    return text, searches
+
+
+def main(sizes=(1000, 2000, 4000, 8000, 16000), runs=5):
+    rng = random.Random(0)
+
+    for remove_duplicates in [False, True]:
+        x = Variable()
+        s = Variable()
+        g = Graph([x, s], Canonicalize(remove_duplicates=remove_duplicates)(x, s))
+        patch_graph(g)
+
+        for size in sizes:
+            text, searches = make_input(size, rng)
+            g.benchmark["run_times"].clear()
+            for _ in range(runs):
+                g.run(text, searches)
+
+            best = min(g.benchmark["run_times"])
+            print(f"remove_duplicates={remove_duplicates!s:5} results={size:6} best={best * 1000:8.2f}ms "
+                  f"per result={best / size * 1e6:6.2f}us")
+
+
+if __name__ == "__main__":
+    main()
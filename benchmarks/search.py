@@ -0,0 +1,50 @@
+"""
+Benchmark the ListSearch engines over growing lists of terms. For each
+engine, this reports the time taken to prepare the matcher and the best time
+to search a text of about 3000 words.
+
+    poetry run python benchmarks/search.py
+"""
+
+import random
+import string
+import time
+
+from lute.graph import Graph
+from lute.node import Variable
+from lute.node.search import ListSearch
+
+ENGINES = ["term", "combined", "trie", "token"]
+
+
+def make_input(n_terms: int, rng: random.Random):
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 8))) for _ in range(max(n_terms, 500))]
+    terms = list(dict.fromkeys(" ".join(rng.sample(words, rng.randint(1, 3))) for _ in range(n_terms)))
+    text = " ".join(rng.choices(words, k=3000))
+
+    return terms, text
+
+
+def main(sizes=(20, 200, 1000, 3000), runs=5):
+    rng = random.Random(0)
+
+    for size in sizes:
+        terms, text = make_input(size, rng)
+        for engine in ENGINES:
+            start = time.time()
+            x = Variable()
+            g = Graph(x, ListSearch(terms, engine=engine)(x))
+            build = time.time() - start
+
+            times = []
+            for _ in range(runs):
+                start = time.time()
+                g.run(text)
+                times.append(time.time() - start)
+
+            print(f"terms={len(terms):5} engine={engine:8} build={build * 1000:8.2f}ms "
+                  f"search={min(times) * 1000:8.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -29,19 +29,26 @@ def patch_node(node: Node, store_size=1000):
     eval_fn = node.eval
 
     def _bm_eval_fn(*args, **kwargs):
+        # Predecessors evaluated before this call are either accounted for by another
+        # successor or, when running through a graph's plan, evaluated just for us
         blacklist = set()
+        par_time = 0
         for par_node in node.predecessors:
             if par_node.evaluated:
                 blacklist.add(par_node.id)
+                if node_has_benchmark(par_node) and not par_node.benchmark.get("claimed", True):
+                    par_node.benchmark["claimed"] = True
+                    par_time += (par_node.benchmark.get("eval_times") or [0])[-1]
 
         start = time.time()
         out = eval_fn(*args, **kwargs)
         end = time.time()
-        node.benchmark["eval_times"].append(end - start)
+        node.benchmark["eval_times"].append(end - start + par_time)
+        node.benchmark["claimed"] = False
 
-        par_time = 0
         for par_node in node.predecessors:
-            if par_node.id not in blacklist:
+            if par_node.id not in blacklist and node_has_benchmark(par_node):
+                par_node.benchmark["claimed"] = True
                 par_time += (par_node.benchmark.get("eval_times") or [0])[-1]
 
         node.benchmark["self_eval_times"].append(node.benchmark["eval_times"][-1] - par_time)
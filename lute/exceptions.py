@@ -14,3 +14,15 @@ class ResolutionException(Exception):
     def __init__(self, node_id, *args, **kwargs):
         message = f"Unable to resolve {node_id}"
         super().__init__(message, *args, **kwargs)
+
+
+class BatchEvalException(Exception):
+    """
+    Exception for failures while evaluating an item of a batch
+    """
+
+    def __init__(self, index, error, *args, **kwargs):
+        message = f"Evaluation failed for item {index}: {error!r}"
+        super().__init__(message, *args, **kwargs)
+        self.index = index
+        self.error = error
@@ -1,12 +1,16 @@
+import asyncio
 import json
 import warnings
+from concurrent.futures import Executor
 from copy import deepcopy
-from typing import Any, Dict, List, Tuple, Union
-
-from pydash import py_
+from queue import SimpleQueue
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
 
+from lute.graph.plan import Liveness, Plan
 from lute.node import Node, Variable
-from lute.node.utils import resolve, walk_node
+from lute.node.frame import Frame, no_frame
+from lute.node.utils import resolve, walk_nodes
+from lute.utils import hash_values
 
 GraphInput = Union[List[Node], Node]
 GraphOutput = Union[List[Node], Node]
@@ -18,37 +22,106 @@ GraphIdInput = Union[List[NodeId], NodeId]
 GraphIdOutput = Union[List[NodeId], NodeId]
 
 
+def _batch_eval_fn(node: Node) -> Optional[Callable]:
+    """
+    Return the `eval_batch` of the node, if it has one matching its `eval`. An
+    `eval` patched on the instance (like by `mute`, benchmarking or the
+    optimizations) without an `eval_batch` along with it means the class's
+    `eval_batch` doesn't do what the node does anymore.
+    """
+
+    if "eval" in vars(node) and "eval_batch" not in vars(node):
+        return None
+
+    return getattr(node, "eval_batch", None)
+
+
 class Graph:
     """
     A DAG with some input and output nodes
+
+    An `incremental` graph keeps values of nodes across runs and only evaluates
+    again the nodes downstream of input Variables whose value changed. This
+    assumes that nodes are pure functions of their predecessors.
     """
 
-    def __init__(self, input: GraphInput, output: GraphOutput):
+    def __init__(self, input: GraphInput, output: GraphOutput, incremental=False):
         self.inputs = input if isinstance(input, list) else [input]
         self.outputs = output if isinstance(output, list) else [output]
+        self.incremental = incremental
+        self.pinned: Set[Node] = set()
+        # Hashes of the values input Variables were last set to, for incremental runs
+        self._input_hashes: Dict[Variable, Optional[str]] = {}
+        self.compile()
+
+    def compile(self):
+        """
+        Index the nodes of the graph and prepare the execution plan for `run`. The
+        plan is a topological ordering of the nodes which the outputs depend on.
+        Since this is done once at creation, call this again if the nodes get
+        rewired afterwards.
+        """
+
+        self._forward = walk_nodes(self.inputs)
+        self._backward = walk_nodes(self.outputs, backward=True)
+        self._forward_set = set(self._forward)
+        self._backward_set = set(self._backward)
+
         self._nodes = self._all_nodes()
         self._nodes_map = {n.name_str(): n for n in self._nodes}
 
+        self._plan = Plan(self.outputs)
+        self._output_plans: Dict[Tuple[NodeId, ...], Plan] = {}
+
+    def _get_plan(self, outputs: GraphIdOutput = None) -> Plan:
+        """
+        Return the plan for computing the given outputs, all graph outputs by default.
+        Plans for subsets of outputs are cached.
+        """
+
+        if outputs is None:
+            return self._plan
+
+        key = tuple(outputs) if isinstance(outputs, list) else (outputs,)
+        try:
+            return self._output_plans[key]
+        except KeyError:
+            plan = Plan([self.resolve_node(o) for o in key])
+            self._output_plans[key] = plan
+            return plan
+
     def _all_nodes(self):
         """
         Return all the nodes involved in the graph.
         """
 
-        return py_.uniq(self._forward_nodes() + self._backward_nodes() + self.inputs + self.outputs)
+        return list(dict.fromkeys(self._forward + self._backward + self.inputs + self.outputs))
 
     def _forward_nodes(self):
         """
         Return a list of all nodes accessible if we follow the input nodes.
         """
 
-        return py_.uniq(py_.flatten([walk_node(n) for n in self.inputs]))
+        return self._forward
 
     def _backward_nodes(self):
         """
         Return a list of all nodes accessible if we follow the output nodes.
         """
 
-        return py_.uniq(py_.flatten([walk_node(n, backward=True) for n in self.outputs]))
+        return self._backward
+
+    def pin(self, *ids: NodeId):
+        """
+        Keep values of the given nodes in frames after runs. Other than the
+        outputs, values in frames are dropped as soon as all their successors
+        have used them.
+        """
+
+        self.pinned.update(self.resolve_node(i) for i in ids)
+
+    def _liveness(self, plan: Plan, frame: Frame) -> Liveness:
+        return Liveness(plan, frame, keep=set(plan.outputs) | self.pinned)
 
     def set_param(self, param: Union[Param, str], value: Any):
         """
@@ -58,6 +131,12 @@ class Graph:
 
         n, attr = self._resolve_param_node(param)
         setattr(n, attr, value)
+        # Cached values are keyed on the changed params too
+        n._changed_params[attr] = value
+        vars(n).pop("_params_digest", None)
+
+        if self.incremental:
+            self._reset_downstream({n})
 
     def _resolve_param_node(self, param: Union[Param, str]) -> Tuple[Node, str]:
         """
@@ -120,7 +199,7 @@ class Graph:
             outputs = output if isinstance(output, list) else [output]
             outputs = [self.resolve_node(o) for o in outputs]
 
-        return Graph(valid_inputs, outputs)
+        return Graph(valid_inputs, outputs, incremental=self.incremental)
 
     def clone(self):
         return deepcopy(self)
@@ -131,7 +210,7 @@ class Graph:
         """
 
         for node in self._nodes:
-            node.clear()
+            node.reset()
 
     def to_dict(self) -> Dict:
         raise NotImplementedError()
@@ -155,7 +234,8 @@ class Graph:
     def type(self):
         return [output.type for output in self.outputs]
 
-    def run(self, *args, values_dict: Dict[Variable, Any] = None):
+    def run(self, *args, values_dict: Dict[Variable, Any] = None, frame: Frame = None,
+            executor: Executor = None, outputs: GraphIdOutput = None):
         """
         Run the graph using values passed.
 
@@ -172,26 +252,281 @@ class Graph:
 
         Otherwise, `args` is assumed to represent the values of all the inputs
         which are Variables (sequentially).
+
+        If a `frame` is passed, all the values for this run are kept in it and the
+        nodes are left untouched. Using a fresh frame for each call, the same
+        graph can be run from multiple threads at once:
+
+        ```python
+        g.run("Hello world", frame=Frame())
+        ```
+
+        Passing an `executor`, like a `ThreadPoolExecutor`, evaluates the nodes in
+        it, each as soon as its predecessors are done. Independent branches then
+        run in parallel. This always keeps the values in a frame.
+
+        While running in a frame, values are dropped from it once all their
+        successors are evaluated, see `pin` for keeping them around.
+
+        To compute only some of the outputs, pass their node ids in `outputs`.
+        Only the nodes these depend on are then evaluated:
+
+        ```python
+        g.run("Hello world", outputs=[entities])
+        ```
         """
 
-        self.clear()
+        plan = self._get_plan(outputs)
+        if plan.async_nodes:
+            raise RuntimeError("Graph has nodes with async eval, use arun instead")
 
-        if values_dict is not None:
-            # Dictionary assignment takes priority
-            for node in values_dict:
-                if isinstance(node, Variable) and node in self.inputs:
-                    node.value = values_dict[node]
+        input_values = self._input_values(args, values_dict)
+
+        if executor is not None:
+            results = self._run_parallel(plan, input_values, frame or Frame(), executor)
+        elif frame is not None:
+            results = self._run_frame(plan, input_values, frame)
         else:
-            valid_inputs = [node for node in self.inputs if isinstance(node, Variable)]
-            if len(valid_inputs) == len(args):
-                for node, val in zip(valid_inputs, args):
-                    node.value = val
-            elif len(args) == 1 and len(args[0]) == len(valid_inputs):
-                for node, val in zip(valid_inputs, args[0]):
-                    node.value = val
+            results = self._run_plain(plan, input_values)
+
+        return results[0] if len(results) == 1 else results
+
+    def _run_plain(self, plan: Plan, input_values: Dict[Variable, Any]) -> List:
+        """
+        Evaluate the plan keeping values on the nodes. This can be called from
+        inside a node's eval while another run's frame is active, which is
+        why that frame is put aside here.
+        """
+
+        with no_frame():
+            if self.incremental:
+                # Going over the whole graph so that nodes outside this plan don't
+                # keep stale values around for later runs
+                input_values = self._changed_inputs(input_values)
+                self._reset_downstream(set(input_values))
+            else:
+                for node in plan:
+                    node.reset()
+
+            for node, val in input_values.items():
+                node.value = val
+
+            # Going in topological order, each node only reads already evaluated
+            # predecessors and we don't pile up recursive `value` calls
+            for node in plan:
+                node.value
+
+            return [output.value for output in plan.outputs]
+
+    def _changed_inputs(self, input_values: Dict[Variable, Any]) -> Dict[Variable, Any]:
+        """
+        Return the input values which differ from what the Variables were set
+        to in the last run. Values are compared by their hashes taken when they
+        were set, so objects mutated in place since then count as changed.
+        Values which can't be hashed always do.
+        """
+
+        changed = {}
+        for node in self.inputs:
+            if isinstance(node, Variable):
+                val = input_values.get(node)
+                val_hash = hash_values(val)
+                if not (node.evaluated and val_hash is not None and self._input_hashes.get(node) == val_hash):
+                    changed[node] = val
+                self._input_hashes[node] = val_hash
+
+        return changed
+
+    def _reset_downstream(self, nodes: Set[Node]):
+        """
+        Reset the given nodes and everything in the plan depending on them.
+        """
+
+        dirty = set(nodes)
+        for node in self._plan:
+            if node in dirty or any(pred in dirty for pred in node.predecessors):
+                dirty.add(node)
+                node.reset()
+
+    def _set_frame_inputs(self, input_values: Dict[Variable, Any], frame: Frame):
+        for node in self.inputs:
+            if isinstance(node, Variable):
+                frame[node] = input_values.get(node)
+
+    def _run_frame(self, plan: Plan, input_values: Dict[Variable, Any], frame: Frame) -> List:
+        """
+        Evaluate the plan keeping all values in the given frame.
+        """
+
+        self._set_frame_inputs(input_values, frame)
+        liveness = self._liveness(plan, frame)
+
+        for node in plan:
+            frame.evaluate(node)
+            liveness.consumed(node)
+
+        return [frame[output] for output in plan.outputs]
+
+    def _run_parallel(self, plan: Plan, input_values: Dict[Variable, Any], frame: Frame,
+                      executor: Executor) -> List:
+        """
+        Evaluate the plan in the executor keeping all values in the given frame.
+        Nodes are submitted as soon as all their predecessors are evaluated.
+        """
+
+        self._set_frame_inputs(input_values, frame)
+
+        liveness = self._liveness(plan, frame)
+        pending = dict(plan.n_predecessors)
+        done: SimpleQueue = SimpleQueue()
+        ready = [node for node in plan if pending[node] == 0]
+        running = 0
+
+        while ready or running:
+            while ready:
+                node = ready.pop()
+                if node in frame:
+                    # Inputs are already there, no need to go through the executor
+                    done.put((node, None))
+                else:
+                    future = executor.submit(frame.evaluate, node)
+                    future.add_done_callback(lambda f, node=node: done.put((node, f)))
+                running += 1
+
+            node, future = done.get()
+            running -= 1
+
+            if future is not None and future.exception() is not None:
+                raise future.exception()
+
+            liveness.consumed(node)
+            for succ in plan.successors[node]:
+                pending[succ] -= 1
+                if pending[succ] == 0:
+                    ready.append(succ)
+
+        return [frame[output] for output in plan.outputs]
+
+    def run_batch(self, input_batch: List, outputs: GraphIdOutput = None) -> List:
+        """
+        Run the graph on a batch of inputs, pushing the whole batch through one
+        node at a time. Each item of the batch is what you would pass to `run`
+        and the outputs are in the same order as items.
+
+        Nodes defining `eval_batch` are called once for the whole batch, others
+        are evaluated item by item. Like in `run`, `outputs` can be used to pick
+        only some of the outputs.
+        """
+
+        plan = self._get_plan(outputs)
+        if plan.async_nodes:
+            raise RuntimeError("Graph has nodes with async eval, batch runs are not supported")
+
+        size = len(input_batch)
+        batch_values = [self._input_values((ip,)) for ip in input_batch]
+
+        # Values in this frame are lists with an item for each input
+        frame = Frame()
+        for node in self.inputs:
+            if isinstance(node, Variable):
+                frame[node] = [values.get(node) for values in batch_values]
+
+        liveness = self._liveness(plan, frame)
+        for node in plan:
+            if node in frame:
+                continue
+
+            eval_batch = _batch_eval_fn(node)
+            if eval_batch is not None:
+                with frame.active():
+                    frame[node] = eval_batch(*node.args, **node.kwargs)
             else:
-                raise Exception("Input values length not matching length of graph inputs")
+                frame[node] = [Frame({pred: frame[pred][idx] for pred in node.predecessors}).evaluate(node)
+                               for idx in range(size)]
+
+            liveness.consumed(node)
+
+        batch_outputs = [frame[output] for output in plan.outputs]
 
-        results = [output.value for output in self.outputs]
+        if len(batch_outputs) == 1:
+            return batch_outputs[0]
+        else:
+            return [list(results) for results in zip(*batch_outputs)]
+
+    async def arun(self, *args, values_dict: Dict[Variable, Any] = None, frame: Frame = None,
+                   executor: Executor = None, outputs: GraphIdOutput = None):
+        """
+        Coroutine version of `run`, values are always kept in a frame. Nodes with
+        `async def eval` are awaited concurrently, each starting as soon as its
+        predecessors are done. Other nodes are evaluated inline or, if passed, in
+        the `executor`.
+
+        ```python
+        results = await g.arun("Hello world")
+        ```
+        """
+
+        plan = self._get_plan(outputs)
+        input_values = self._input_values(args, values_dict)
+        frame = frame or Frame()
+        self._set_frame_inputs(input_values, frame)
+
+        loop = asyncio.get_running_loop()
+        liveness = self._liveness(plan, frame)
+        pending = dict(plan.n_predecessors)
+        ready = [node for node in plan if pending[node] == 0]
+        running: Dict[asyncio.Future, Node] = {}
+
+        try:
+            while ready or running:
+                finished = []
+                while ready:
+                    node = ready.pop()
+                    if node in frame:
+                        finished.append(node)
+                    elif node in plan.async_nodes:
+                        running[asyncio.ensure_future(frame.aevaluate(node))] = node
+                    elif executor is not None:
+                        running[loop.run_in_executor(executor, frame.evaluate, node)] = node
+                    else:
+                        frame.evaluate(node)
+                        finished.append(node)
+
+                if not finished:
+                    done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                        finished.append(running.pop(future))
+
+                for node in finished:
+                    liveness.consumed(node)
+                    for succ in plan.successors[node]:
+                        pending[succ] -= 1
+                        if pending[succ] == 0:
+                            ready.append(succ)
+        finally:
+            for future in running:
+                future.cancel()
+
+        results = [frame[output] for output in plan.outputs]
 
         return results[0] if len(results) == 1 else results
+
+    def _input_values(self, args, values_dict: Dict[Variable, Any] = None) -> Dict[Variable, Any]:
+        """
+        Map the input Variables to their values for a run. See `run` for the ways
+        in which values can be passed.
+        """
+
+        if values_dict is not None:
+            # Dictionary assignment takes priority
+            return {node: values_dict[node] for node in values_dict
+                    if isinstance(node, Variable) and node in self.inputs}
+
+        valid_inputs = [node for node in self.inputs if isinstance(node, Variable)]
+        if len(valid_inputs) == len(args):
+            return dict(zip(valid_inputs, args))
+        elif len(args) == 1 and len(args[0]) == len(valid_inputs):
+            return dict(zip(valid_inputs, args[0]))
+        else:
+            raise Exception("Input values length not matching length of graph inputs")
@@ -3,10 +3,202 @@ Stuff for working with batches of data
 """
 
 
-from typing import List
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Any, Dict, Generator, Iterable, Iterator, List, Optional, Tuple, cast
 
+from lute.exceptions import BatchEvalException
 from lute.graph import Graph
+from lute.utils import hash_values
 
+# Graph for a worker process, set once by the pool initializer
+_worker_graph: Graph
 
-def batch_eval(g: Graph, input_batch: List) -> List:
-    return [g.run(ip) for ip in input_batch]
+
+def _init_worker(g: Graph):
+    global _worker_graph
+    _worker_graph = g
+
+
+def _try_run(g: Graph, ip) -> Tuple[Any, Optional[Exception]]:
+    try:
+        return g.run(ip), None
+    except Exception as e:
+        return None, e
+
+
+def _worker_run(ip) -> Tuple[Any, Optional[Exception]]:
+    return _try_run(_worker_graph, ip)
+
+
+def _worker_run_batch(input_batch: List) -> List:
+    return _worker_graph.run_batch(input_batch)
+
+
+def _tagged(value) -> Any:
+    """
+    Tag the value, and items of tuples and frozensets in it, with their types so
+    that equal values of different types (like 1 and True) get different keys.
+    """
+
+    if isinstance(value, tuple):
+        return type(value), tuple(_tagged(v) for v in value)
+    elif isinstance(value, frozenset):
+        return type(value), frozenset(_tagged(v) for v in value)
+
+    return type(value), value
+
+
+def _dedupe(input_batch: List) -> Tuple[List, List[int]]:
+    """
+    Return the unique items of the batch along with, for each item, the position
+    of its unique version. Items which can't be hashed are kept as unique.
+    """
+
+    unique = []
+    positions = []
+    seen: Dict[Any, int] = {}
+
+    for ip in input_batch:
+        try:
+            key = _tagged(ip)
+            hash(key)
+        except TypeError:
+            key = hash_values(ip)
+
+        pos = seen.get(key) if key is not None else None
+        if pos is None:
+            pos = len(unique)
+            unique.append(ip)
+            if key is not None:
+                seen[key] = pos
+        positions.append(pos)
+
+    return unique, positions
+
+
+def _prepare(input_batch: List, dedupe=False, stats: Dict = None) -> Tuple[List, Optional[List[int]]]:
+    """
+    Return items to evaluate for the batch and, if deduplicating, the positions
+    for fanning their outputs out. Stats are accumulated in the given dict.
+    """
+
+    if not dedupe:
+        return input_batch, None
+
+    items, positions = _dedupe(input_batch)
+
+    if stats is not None:
+        stats["items"] = stats.get("items", 0) + len(input_batch)
+        stats["unique"] = stats.get("unique", 0) + len(items)
+        stats["dedupe_ratio"] = 1 - stats["unique"] / stats["items"] if stats["items"] else 0.0
+
+    return items, positions
+
+
+def _fan_out(outputs: List, positions: Optional[List[int]] = None) -> List:
+    return outputs if positions is None else [outputs[pos] for pos in positions]
+
+
+def batch_eval(g: Graph, input_batch: List, workers: int = None, chunksize: int = 1,
+               return_exceptions=False, dedupe=False, stats: Dict = None) -> List:
+    """
+    Run the graph on each item of the batch, keeping the order of items.
+
+    If `workers` is given, items are evaluated in that many processes. The graph
+    is sent to each worker only once, at start, and items are then streamed to
+    them in chunks of `chunksize`.
+
+    With `workers`, a failing item raises BatchEvalException which tells the
+    item's index. Without them, the item's exception is raised as it is. With
+    `return_exceptions`, the exception is put in place of the item's output.
+
+    With `dedupe`, each unique item is evaluated only once and its output is
+    shared by all its copies. If a `stats` dict is passed, counts of `items`,
+    `unique` items and the `dedupe_ratio` (fraction of evaluations saved) are
+    put in it.
+    """
+
+    items, positions = _prepare(input_batch, dedupe, stats)
+
+    if workers is None and not return_exceptions:
+        outputs = [g.run(ip) for ip in items]
+    elif workers is None:
+        outputs = _collect((_try_run(g, ip) for ip in items), return_exceptions, positions)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(g,)) as pool:
+            # map gives back a generator, whose close cancels the pending futures
+            results = cast(Generator[Tuple[Any, Optional[Exception]], None, None],
+                           pool.map(_worker_run, items, chunksize=chunksize))
+            try:
+                outputs = _collect(results, return_exceptions, positions)
+            finally:
+                # On errors, cancel the items not started yet instead of waiting
+                # for them while leaving the pool
+                results.close()
+
+    return _fan_out(outputs, positions)
+
+
+def _collect(outputs, return_exceptions=False, positions: Optional[List[int]] = None) -> List:
+    results = []
+
+    for idx, (output, error) in enumerate(outputs):
+        if error is None:
+            results.append(output)
+        elif return_exceptions:
+            results.append(error)
+        else:
+            # With deduplication, report the first item this came from
+            item_idx = idx if positions is None else positions.index(idx)
+            raise BatchEvalException(item_idx, error) from error
+
+    return results
+
+
+def _chunked(items: Iterable, size: int) -> Iterator[List]:
+    it = iter(items)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def stream_eval(g: Graph, inputs: Iterable, batch_size: int = 1, workers: int = None,
+                window: int = None, dedupe=False, stats: Dict = None) -> Iterator:
+    """
+    Run the graph on items lazily pulled from `inputs`, which can be any iterable,
+    yielding outputs in order. Items are taken in micro batches of `batch_size`
+    and evaluated using `run_batch`.
+
+    If `workers` is given, batches are evaluated in that many processes, with at
+    most `window` (default twice the workers) batches in flight. Like in
+    `batch_eval`, the graph is sent to each worker only once.
+
+    `dedupe` and `stats` work like in `batch_eval`, with duplicates removed
+    within each micro batch.
+    """
+
+    batches = _chunked(inputs, batch_size)
+
+    if workers is None:
+        for input_batch in batches:
+            items, positions = _prepare(input_batch, dedupe, stats)
+            yield from _fan_out(g.run_batch(items), positions)
+        return
+
+    window = window or 2 * workers
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(g,)) as pool:
+        in_flight: deque = deque()
+        for input_batch in batches:
+            items, positions = _prepare(input_batch, dedupe, stats)
+            in_flight.append((pool.submit(_worker_run_batch, items), positions))
+            if len(in_flight) >= window:
+                future, positions = in_flight.popleft()
+                yield from _fan_out(future.result(), positions)
+
+        while in_flight:
+            future, positions = in_flight.popleft()
+            yield from _fan_out(future.result(), positions)
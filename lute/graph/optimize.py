@@ -2,9 +2,12 @@
 Graph optimization utilities
 """
 
+from typing import Any, Dict
+
 from lute.graph.base import Graph
 from lute.node.utils import walk_node
-from lute.node import Node
+from lute.node import Constant, Frame, Node, Variable
+from lute.node.base import BOOKKEEPING_ATTRS
 from pydash import py_
 
 
@@ -14,11 +17,168 @@ def prune(g: Graph) -> Graph:
     Mutates the involved nodes when removing danglers.
     """
 
-    required_inputs = [i for i in g.inputs if i in g._backward_nodes()]
+    required_inputs = [i for i in g.inputs if i in g._backward_set]
 
     for node in g._forward_nodes():
         if node not in g.outputs and len(node.successors) == 0:
             for pnode in node.predecessors:
                 pnode.successors.remove(node)
 
-    return Graph(required_inputs, g.outputs)
+    return Graph(required_inputs, g.outputs, incremental=g.incremental)
+
+
+class _Frozen:
+    """
+    Stand-in `eval` for folded nodes. Unlike a lambda, this pickles so folded
+    graphs can be sent to worker processes.
+    """
+
+    def __init__(self, value: Any):
+        self.value = value
+
+    def __call__(self):
+        return self.value
+
+
+class _Forward:
+    """
+    Stand-in `eval` (and `eval_batch`) for merged nodes, passing on the value of
+    the node they were merged into.
+    """
+
+    def __call__(self, target: Node):
+        return target.value
+
+
+def _freeze(node: Node, value):
+    """
+    Detach the node from its predecessors and make it always evaluate to the
+    given value.
+    """
+
+    for pnode in dict.fromkeys(node.predecessors):
+        pnode.successors.remove(node)
+
+    node.predecessors = []
+    node.args = []
+    node.kwargs = {}
+    node.eval = _Frozen(value)
+    # The class's eval_batch would compute from the detached predecessors
+    node.eval_batch = None
+    # The value is fixed, there is nothing left to cache
+    node.cache = None
+    node.folded = True
+
+
+def fold_constants(g: Graph) -> Graph:
+    """
+    Evaluate parts of the graph which only depend on Constant nodes once and
+    turn them into constants so that runs only do the input dependent work.
+    This assumes the nodes are pure functions of their inputs. Mutates the
+    folded nodes in place, keeping references to them valid.
+    """
+
+    constant = set()
+    for node in g._plan:
+        if isinstance(node, Constant):
+            constant.add(node)
+        elif isinstance(node, Variable) or node in g._plan.async_nodes or node.fan_in == 0:
+            continue
+        elif all(pnode in constant for pnode in node.predecessors):
+            constant.add(node)
+
+    # Only the nodes at the boundary need their values, everything behind them
+    # drops out of the graph
+    folded = [node for node in g._plan if node in constant and not isinstance(node, Constant) and
+              (node in g.outputs or any(succ not in constant for succ in node.successors))]
+
+    frame = Frame()
+    for node in g._plan:
+        if node in constant:
+            frame.evaluate(node)
+
+    for node in folded:
+        _freeze(node, frame[node])
+
+    return Graph(g.inputs, g.outputs, incremental=g.incremental)
+
+
+def _same(a, b, canon: Dict[Node, Node]) -> bool:
+    """
+    Check if the two attribute values are the same, comparing nodes after
+    mapping them to their canonical versions.
+    """
+
+    if isinstance(a, Node) or isinstance(b, Node):
+        return isinstance(a, Node) and isinstance(b, Node) and canon.get(a, a) is canon.get(b, b)
+    elif type(a) is not type(b):
+        return False
+    elif isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(_same(x, y, canon) for x, y in zip(a, b))
+    elif isinstance(a, dict):
+        return a.keys() == b.keys() and all(_same(a[k], b[k], canon) for k in a)
+
+    try:
+        return bool(a == b)
+    except Exception:
+        return False
+
+
+def _same_node(a: Node, b: Node, canon: Dict[Node, Node]) -> bool:
+    a_attrs = {k: v for k, v in vars(a).items() if k not in BOOKKEEPING_ATTRS}
+    b_attrs = {k: v for k, v in vars(b).items() if k not in BOOKKEEPING_ATTRS}
+
+    return _same(a_attrs, b_attrs, canon)
+
+
+def _forward(node: Node, target: Node):
+    """
+    Detach the node from its predecessors and make it pass on the value of target.
+    """
+
+    for pnode in dict.fromkeys(node.predecessors):
+        pnode.successors.remove(node)
+
+    node.predecessors = [target]
+    target.successors.append(node)
+    node.args = [target]
+    node.kwargs = {}
+    node.eval = _Forward()
+    node.eval_batch = _Forward()
+    # The target does the work, caching that is enough
+    node.cache = None
+    node.merged_into = target
+
+
+def merge_duplicates(g: Graph) -> Graph:
+    """
+    Find nodes doing the same computation (same class and parameters, working
+    on the same predecessors) and keep only one of them evaluating. The others
+    just pass on its value, so successors and outputs referring to them stay
+    valid. This assumes the nodes are pure functions of their inputs. Mutates
+    the involved nodes.
+    """
+
+    canon: Dict[Node, Node] = {}
+    buckets: Dict = {}
+
+    for node in g._plan:
+        # Inputs are different by definition and patched nodes (muted,
+        # benchmarked etc.) don't compute what their class says
+        if isinstance(node, Variable) or "eval" in vars(node):
+            continue
+
+        key = (type(node), tuple(id(canon.get(pnode, pnode)) for pnode in node.predecessors))
+        candidates = buckets.setdefault(key, [])
+
+        for candidate in candidates:
+            if _same_node(node, candidate, canon):
+                canon[node] = candidate
+                break
+        else:
+            candidates.append(node)
+
+    for node, target in canon.items():
+        _forward(node, target)
+
+    return Graph(g.inputs, g.outputs, incremental=g.incremental)
@@ -0,0 +1,64 @@
+"""
+Execution plans for graphs
+"""
+
+from inspect import iscoroutinefunction
+from typing import Dict, List, Set
+
+from lute.node import Frame, Node
+from lute.node.utils import topological_sort
+
+
+class Plan:
+    """
+    Precomputed order of evaluation for getting values of a set of output nodes,
+    along with the dependency counts needed for scheduling nodes as soon as their
+    predecessors are done.
+    """
+
+    def __init__(self, outputs: List[Node]):
+        self.outputs = outputs
+        self.order = topological_sort(outputs)
+        self.predecessors: Dict[Node, List[Node]] = {}
+        self.successors: Dict[Node, List[Node]] = {node: [] for node in self.order}
+        self.n_predecessors: Dict[Node, int] = {}
+        self.async_nodes: Set[Node] = {node for node in self.order if iscoroutinefunction(node.eval)}
+
+        for node in self.order:
+            # Same node can be passed multiple times, like in `x + x`
+            preds = list(dict.fromkeys(node.predecessors))
+            self.predecessors[node] = preds
+            self.n_predecessors[node] = len(preds)
+            for pred in preds:
+                self.successors[pred].append(node)
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+
+class Liveness:
+    """
+    Keeps count of the consumers left for each value in a run of the plan and
+    drops values from the frame as soon as their last consumer is done. Values
+    of the `keep` nodes are never dropped.
+    """
+
+    def __init__(self, plan: Plan, frame: Frame, keep: Set[Node]):
+        self.plan = plan
+        self.frame = frame
+        self.keep = keep
+        self.remaining = {node: len(succs) for node, succs in plan.successors.items()}
+
+    def consumed(self, node: Node):
+        """
+        Mark the node as evaluated, releasing predecessors which are not needed
+        anymore.
+        """
+
+        for pred in self.plan.predecessors[node]:
+            self.remaining[pred] -= 1
+            if self.remaining[pred] == 0 and pred not in self.keep:
+                self.frame.release(pred)
@@ -1 +1,2 @@
 from .base import Constant, GraphNode, Identity, Node, Variable
+from .frame import Frame
@@ -1,10 +1,38 @@
 import json
 import operator
+import warnings
 from abc import ABCMeta, abstractmethod
 from copy import deepcopy
 from typing import Any, Dict
 
-from lute.utils import clip_to_len
+from lute.node.frame import Frame, current_frame
+from lute.utils import clip_to_len, hash_values
+
+# Attributes which keep track of a node's place and state in a graph rather
+# than what it computes
+BOOKKEEPING_ATTRS = {"id", "name", "_type", "_output_val", "evaluated", "predecessors", "successors",
+                     "cache", "benchmark", "_params_digest", "_init_args", "_call_args", "_changed_params",
+                     "merged_into", "folded"}
+
+
+def _stable_value(value, positions: Dict["Node", int]):
+    """
+    Return the value with nodes replaced by their positions and sets by sorted
+    lists, so that it pickles to the same bytes in every process.
+    """
+
+    if isinstance(value, Node):
+        return "<node {}>".format(positions.get(value))
+    elif isinstance(value, list):
+        return [_stable_value(v, positions) for v in value]
+    elif isinstance(value, tuple):
+        return tuple(_stable_value(v, positions) for v in value)
+    elif isinstance(value, dict):
+        return {_stable_value(k, positions): _stable_value(v, positions) for k, v in value.items()}
+    elif isinstance(value, (set, frozenset)):
+        return type(value).__name__, tuple(sorted((_stable_value(v, positions) for v in value), key=repr))
+
+    return value
 
 
 class NodeTuple:
@@ -39,6 +67,8 @@ class NodeMeta(ABCMeta):
 
     1. Autogenerate Node ids for new instances.
     2. Setup a few parameters without needing to call super.
+    3. Keep the arguments the node was constructed and called with, which make
+       up its cache keys.
     """
 
     def __new__(meta_cls, *args, **kwargs):
@@ -52,28 +82,56 @@ class NodeMeta(ABCMeta):
         if cls.__name__ != base_cls:
             original_init = cls.__init__
 
-            def __init__(self, *args, name=None, type=None, **kwargs):
+            def __init__(self, *args, name=None, type=None, cache=None, **kwargs):
                 original_init(self, *args, **kwargs)
                 set_safe(self, "id", cls.__gen_id__())
                 set_safe(self, "name", name)
                 set_safe(self, "_type", type)
+                set_safe(self, "cache", cache)
                 set_safe(self, "_output_val", None)
                 set_safe(self, "evaluated", False)
                 set_safe(self, "predecessors", [])
                 set_safe(self, "successors", [])
                 set_safe(self, "args", [])
                 set_safe(self, "kwargs", {})
+                set_safe(self, "_call_args", ((), {}))
+                set_safe(self, "_changed_params", {})
+                # Set last so that the outermost class's arguments are kept
+                self._init_args = (args, kwargs)
 
             __init__.__wrapped__ = original_init
 
             cls.__init__ = __init__
 
+        if "__call__" in vars(cls):
+            original_call = cls.__call__
+
+            def __call__(self, *args, **kwargs):
+                out = original_call(self, *args, **kwargs)
+                self._call_args = (args, kwargs)
+                self.__dict__.pop("_params_digest", None)
+                return out
+
+            __call__.__wrapped__ = original_call
+
+            cls.__call__ = __call__
+
         return cls
 
 
 class Node(metaclass=NodeMeta):
     """
     Base class for all nodes
+
+    Nodes can optionally define an `eval_batch` method, with the same arguments as
+    `eval`, for evaluating a whole batch in one call (see `Graph.run_batch`). Inside
+    it, `value` of each argument node is the list of its values for the batch and
+    the method returns the list of outputs.
+
+    Any node can be given a `cache` (like `lute.node.cache.LRUCache`) keyword
+    argument. Values are then memoized on the node's class, the arguments it
+    was constructed and called with and the values of its predecessors, and
+    repeated inputs skip `eval`.
     """
     _count = -1
 
@@ -92,14 +150,90 @@ class Node(metaclass=NodeMeta):
         """
         Value of the node is the `value` that the nodal computation generates. It is created by
         calling the eval function and, usually, cached.
+
+        If a `Frame` is active, the value is kept in the frame instead of the node.
         """
 
+        frame = current_frame()
+        if frame is not None:
+            return frame.evaluate(self)
+
         if not self.evaluated:
-            self._output_val = self.eval(*self.args, **self.kwargs)
+            self._output_val = self._evaluate()
             self.evaluated = True
 
         return self._output_val
 
+    def _evaluate(self):
+        """
+        Call eval with the arguments the node was called on, going through the
+        cache if the node has one.
+        """
+
+        key = self._cache_key()
+        if key is None:
+            return self.eval(*self.args, **self.kwargs)
+
+        try:
+            return self.cache[key]
+        except KeyError:
+            value = self.eval(*self.args, **self.kwargs)
+            self.cache[key] = value
+            return value
+
+    async def _aevaluate(self):
+        """
+        Version of `_evaluate` for nodes with `async def eval`.
+        """
+
+        key = self._cache_key()
+        if key is None:
+            return await self.eval(*self.args, **self.kwargs)
+
+        try:
+            return self.cache[key]
+        except KeyError:
+            value = await self.eval(*self.args, **self.kwargs)
+            self.cache[key] = value
+            return value
+
+    def _cache_key(self):
+        """
+        Key for the cache made from the node's class, the arguments it was
+        constructed and called with, params changed by `Graph.set_param` and the
+        values of predecessors. This is None, with a warning, when there is no
+        cache or the key can't be built.
+        """
+
+        if self.cache is None:
+            return None
+
+        params_key = self._params_key()
+        key = None if params_key is None else hash_values(
+            [params_key, _stable_value([pred.value for pred in self.predecessors], {})])
+
+        if key is None:
+            warnings.warn("Can't build a cache key for node {}, its values won't be cached".format(self.id))
+
+        return key
+
+    def _params_key(self):
+        """
+        Hash of everything but the predecessors' values going in the cache key.
+        This is computed once, calling the node again or changing a param drops
+        it. Nodes in the call arguments are keyed by their position among the
+        predecessors.
+        """
+
+        if "_params_digest" not in vars(self):
+            positions = {pred: idx for idx, pred in enumerate(self.predecessors)}
+            self._params_digest = hash_values([
+                type(self).__module__, type(self).__qualname__,
+                _stable_value([self._init_args, sorted(self._changed_params.items()), self._call_args], positions)
+            ])
+
+        return self._params_digest
+
     @property
     def type(self):
         return self._type
@@ -120,15 +254,22 @@ class Node(metaclass=NodeMeta):
 
         # Guarding against cyclic traps
         if self.evaluated:
-            self.evaluated = False
-
-            # Free some memory too
-            self._output_val = None
+            self.reset()
 
             # Free up all successors too
             for succ in self.successors:
                 succ.clear()
 
+    def reset(self):
+        """
+        clears the cached output of only this node, leaving successors untouched
+        """
+
+        self.evaluated = False
+
+        # Free some memory too
+        self._output_val = None
+
     def _register_predecessors(self, predecessors):
         """
         Register the given nodes as this node's predecessors. If a program needs to
@@ -291,6 +432,9 @@ class BinOp(Node):
     def eval(self, a: Node, b: Node):
         return self.op(a.value, b.value)
 
+    def eval_batch(self, a: Node, b: Node):
+        return [self.op(x, y) for x, y in zip(a.value, b.value)]
+
 
 class Constant(Node):
     """
@@ -344,6 +488,9 @@ class Identity(Node):
     def eval(self, _input):
         return _input.value
 
+    def eval_batch(self, _input):
+        return _input.value
+
 
 class GraphNode(Node):
     """
@@ -359,4 +506,6 @@ class GraphNode(Node):
         return self.g.type
 
     def eval(self, *args, **kwargs):
-        return self.g.run(*[a.value for a in args])
+        # Keep the inner graph's values off its nodes if we are running in a frame
+        frame = Frame() if current_frame() is not None else None
+        return self.g.run(*[a.value for a in args], frame=frame)
@@ -0,0 +1,245 @@
+"""
+Caches for memoizing node values
+"""
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class LRUCache:
+    """
+    In memory, least recently used, cache for node values. It can be bounded in
+    number of entries and in total bytes (of pickled values) and entries can be
+    made to expire after `ttl` seconds. `hits` and `misses` keep the counts of
+    lookups.
+
+    Being keyed on values of the predecessors, this should only be used with
+    nodes which are pure functions of their inputs. Cached values are shared
+    between runs, so they shouldn't be mutated by the successors.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = None, ttl: float = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key: str):
+        with self._lock:
+            try:
+                value, size, stored_at = self._items[key]
+            except KeyError:
+                self.misses += 1
+                raise
+
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                self._remove(key)
+                self.misses += 1
+                raise KeyError(key)
+
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key: str, value):
+        if self.max_bytes is not None:
+            try:
+                size = len(pickle.dumps(value, protocol=4))
+            except Exception:
+                # We can't account for this value so we won't keep it
+                return
+
+            if size > self.max_bytes:
+                return
+        else:
+            size = 0
+
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+
+            self._items[key] = (value, size, time.monotonic())
+            self._bytes += size
+
+            while len(self._items) > self.max_entries or \
+                    (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._items)))
+
+    def _remove(self, key: str):
+        _, size, _ = self._items.pop(key)
+        self._bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class _ForkGuard:
+    """
+    Lets database operations from many threads run together but keeps forks
+    from happening in the middle of one. A child forked while another thread
+    holds a sqlite lock inherits the lock's bookkeeping, but not the lock, and
+    can't use the database after that.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._active = 0
+        self._forking = False
+
+    @contextmanager
+    def operation(self):
+        with self._cond:
+            while self._forking:
+                self._cond.wait()
+            self._active += 1
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                if self._active == 0:
+                    self._cond.notify_all()
+
+    def before_fork(self):
+        self._cond.acquire()
+        self._forking = True
+        while self._active:
+            self._cond.wait()
+
+    def after_fork_in_parent(self):
+        self._forking = False
+        self._cond.notify_all()
+        self._cond.release()
+
+    def after_fork_in_child(self):
+        # Operations of other threads never finish in the child
+        self.__init__()
+
+
+_fork_guard = _ForkGuard()
+
+os.register_at_fork(before=_fork_guard.before_fork,
+                    after_in_parent=_fork_guard.after_fork_in_parent,
+                    after_in_child=_fork_guard.after_fork_in_child)
+
+
+class DiskCache:
+    """
+    Cache for node values kept in a sqlite database on disk. Values survive
+    restarts and the database can be shared by many processes (and threads) on
+    a host. Keys are built from the node's class and arguments (see `Node`),
+    so nodes constructed and called differently don't share entries, while the
+    same node built in another process finds them. `namespace`s split up the
+    entries further, e.g. for clearing some of them.
+    Entries can be made to expire after `ttl` seconds. `hits` and `misses` keep
+    the counts of lookups made by this process.
+
+    Like `LRUCache`, this should only be used with nodes which are pure
+    functions of their inputs.
+    """
+
+    def __init__(self, path: str, namespace: str = "default", ttl: float = None):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        with _fork_guard.operation():
+            self._connection().execute(
+                "CREATE TABLE IF NOT EXISTS node_values ("
+                "namespace TEXT, key TEXT, value BLOB, stored_at REAL, PRIMARY KEY (namespace, key))"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Return a connection for the current thread. Connections are not reused
+        across forks, the child opens its own and leaves the inherited ones
+        alone. This must be used inside `_fork_guard.operation()`.
+
+        NOTE: We keep the default rollback journal instead of WAL. With WAL,
+              processes forked while the parent has the database open share
+              sqlite's in memory state of the shared memory file and can
+              fail with I/O errors once it's recreated.
+        """
+
+        if getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+
+        return self._local.conn
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def __getitem__(self, key: str):
+        with _fork_guard.operation():
+            conn = self._connection()
+            row = conn.execute("SELECT value, stored_at FROM node_values WHERE namespace = ? AND key = ?",
+                               (self.namespace, key)).fetchone()
+
+            if row is None:
+                self._count(hit=False)
+                raise KeyError(key)
+
+            if self.ttl is not None and time.time() - row[1] > self.ttl:
+                conn.execute("DELETE FROM node_values WHERE namespace = ? AND key = ?", (self.namespace, key))
+                self._count(hit=False)
+                raise KeyError(key)
+
+            self._count(hit=True)
+
+        return pickle.loads(row[0])
+
+    def __setitem__(self, key: str, value):
+        try:
+            blob = pickle.dumps(value, protocol=4)
+        except Exception:
+            return
+
+        with _fork_guard.operation():
+            self._connection().execute("INSERT OR REPLACE INTO node_values VALUES (?, ?, ?, ?)",
+                                       (self.namespace, key, blob, time.time()))
+
+    def clear(self):
+        with _fork_guard.operation():
+            self._connection().execute("DELETE FROM node_values WHERE namespace = ?", (self.namespace,))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._local = threading.local()
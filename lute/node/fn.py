@@ -8,6 +8,7 @@ from textwrap import dedent
 from uuid import uuid4
 
 from lute.node.base import Constant, Node, NodeMeta
+from lute.node.frame import no_frame
 
 
 def is_lambda(v) -> bool:
@@ -149,7 +150,9 @@ def node_fn(*args, **kwargs):
             c_kwargs = {k: Constant(kwargs[k]) for k in kwargs}
             inst.clear()
             inst(*c_args, **c_kwargs)
-            return inst.value
+            # Values stay on the node even if called from an eval running in a frame
+            with no_frame():
+                return inst.value
 
         return _wrapper
 
@@ -0,0 +1,98 @@
+"""
+Per run storage for node values
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+_active_frame: ContextVar = ContextVar("lute_active_frame", default=None)
+
+
+def current_frame() -> Optional["Frame"]:
+    """
+    Return the frame active in the current context (thread or task), if any.
+    """
+
+    return _active_frame.get()
+
+
+@contextmanager
+def no_frame():
+    """
+    Run the enclosed block without an active frame, so that nodes keep their
+    values on themselves. Plain runs of graphs started from inside a node's
+    `eval` need this to stay off the outer run's frame.
+    """
+
+    token = _active_frame.set(None)
+    try:
+        yield
+    finally:
+        _active_frame.reset(token)
+
+
+class Frame:
+    """
+    Holds the values of nodes for a single run. While a frame is active, the
+    `value` of a node is read from (and evaluated into) the frame instead of the
+    node itself. Since the nodes are left untouched, a shared graph can be run
+    concurrently with a separate frame for each run.
+    """
+
+    def __init__(self, values: Dict[Any, Any] = None):
+        self.values = dict(values) if values else {}
+
+    def __getitem__(self, node):
+        return self.values[node]
+
+    def __setitem__(self, node, value):
+        self.values[node] = value
+
+    def __contains__(self, node) -> bool:
+        return node in self.values
+
+    def release(self, node):
+        """
+        Drop the value of the node from this frame.
+        """
+
+        self.values.pop(node, None)
+
+    @contextmanager
+    def active(self):
+        """
+        Make this the active frame for the enclosed block.
+        """
+
+        token = _active_frame.set(self)
+        try:
+            yield self
+        finally:
+            _active_frame.reset(token)
+
+    def evaluate(self, node):
+        """
+        Return value of the node in this frame, evaluating it if not done already.
+        """
+
+        try:
+            return self.values[node]
+        except KeyError:
+            with self.active():
+                value = node._evaluate()
+            self.values[node] = value
+            return value
+
+    async def aevaluate(self, node):
+        """
+        Coroutine version of `evaluate` for nodes with an `async def eval`.
+        """
+
+        try:
+            return self.values[node]
+        except KeyError:
+            with self.active():
+                value = await node._aevaluate()
+            self.values[node] = value
+            return value
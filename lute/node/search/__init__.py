@@ -1 +1,2 @@
+from .fuzzy import FuzzySearch
 from .generic import Canonicalize, ExpansionSearch, ListSearch
@@ -2,7 +2,7 @@
 Constraint finding nodes
 """
 
-from typing import Any, Dict, List, Union
+from typing import Any, Collection, Dict, List, Optional, Tuple, Union
 
 from pydash import py_
 from sklearn.feature_extraction.text import TfidfVectorizer
@@ -19,16 +19,51 @@ class ConstraintSearch(Node):
     """
     Return what constraints are satisfied. A constraint is a dict with a str mapping
     to a value.
+
+    Constraints are indexed by their (key, value) items so that only the ones
+    with some value present in the inputs are looked at. Constraints with `None`
+    values (which are never missing) or unhashable values are always looked at.
+    Use `top_k` to keep only the top scoring results.
     """
 
-    def __init__(self, cs: List[Constraint], partial=False):
+    def __init__(self, cs: List[Constraint], partial=False, top_k: Optional[int] = None):
         self.constraints = cs
         self.partial = partial
+        self.top_k = top_k
         self.keys = self._find_all_keys()
+        self._build_index()
 
     def _find_all_keys(self) -> List[str]:
         return py_.uniq(py_.flatten([list(c["items"].keys()) for c in self.constraints]))
 
+    def _build_index(self):
+        """
+        Map (key, value) items to indices of constraints having them and keep
+        the number of such items in each constraint.
+        """
+
+        self._index: Dict[Tuple[str, Any], List[int]] = {}
+        self._n_indexed: List[int] = []
+        self._always: List[int] = []
+
+        for idx, c in enumerate(self.constraints):
+            n_indexed = 0
+            always = False
+            for key, value in c["items"].items():
+                if value is None:
+                    always = True
+                    continue
+
+                try:
+                    self._index.setdefault((key, value), []).append(idx)
+                    n_indexed += 1
+                except TypeError:
+                    always = True
+
+            self._n_indexed.append(n_indexed)
+            if always:
+                self._always.append(idx)
+
     def __call__(self, input_map: Dict[str, Node]):
         if any([key not in input_map for key in self.keys]):
             raise KeyError("Not all constraint keys present in input map")
@@ -38,26 +73,79 @@ class ConstraintSearch(Node):
 
         return self
 
-    def _missing_keys(self, c: Constraint) -> List[str]:
+    def _input_values(self) -> Dict[str, Collection]:
+        """
+        Values present for each key, as sets where possible.
+        """
+
+        input_values: Dict[str, Collection] = {}
+        for key in self.keys:
+            values = [it["value"] for it in self._input_map[key].value]
+            try:
+                input_values[key] = set(values)
+            except TypeError:
+                input_values[key] = values
+
+        return input_values
+
+    def _missing_keys(self, c: Constraint, input_values: Dict[str, Collection]) -> List[str]:
         missing = []
 
         for key in c:
             if c[key] is not None:
-                values = [it["value"] for it in self._input_map[key].value]
-                if c[key] not in values:
+                try:
+                    present = c[key] in input_values[key]
+                except TypeError:
+                    # Unhashable value checked against a set
+                    present = c[key] in list(input_values[key])
+
+                if not present:
                     missing.append(key)
 
         return missing
 
+    def _candidates(self, input_values: Dict[str, Collection]) -> List[int]:
+        """
+        Indices of constraints which can pass the filter, in order.
+        """
+
+        hits: Dict[int, int] = {}
+        for key, values in input_values.items():
+            # Values of a key are a list if any is unhashable, count each once
+            seen = set()
+            for value in values:
+                try:
+                    if value in seen:
+                        continue
+                    seen.add(value)
+                except TypeError:
+                    continue
+
+                for idx in self._index.get((key, value), []):
+                    hits[idx] = hits.get(idx, 0) + 1
+
+        if self.partial:
+            candidates = set(hits)
+        else:
+            # All indexed items need to be present, including for constraints
+            # with nothing indexed
+            candidates = {idx for idx, n in enumerate(self._n_indexed) if n == 0}
+            candidates.update(idx for idx, n in hits.items() if n == self._n_indexed[idx])
+
+        candidates.update(self._always)
+        return sorted(candidates)
+
     def eval(self):
         """
         Return constraints and missing keys
         """
 
+        input_values = self._input_values()
         results = []
 
-        for c in self.constraints:
-            missing_keys = self._missing_keys(c["items"])
+        for idx in self._candidates(input_values):
+            c = self.constraints[idx]
+            missing_keys = self._missing_keys(c["items"], input_values)
             score = 1 - (len(missing_keys) / len(c["items"]))
 
             results.append({
@@ -71,17 +159,60 @@ class ConstraintSearch(Node):
         results = sorted(results, key=lambda c: c["score"], reverse=True)
 
         if self.partial:
-            return py_.filter(results, lambda it: len(it["missing"]) < len(it["constraint"]))
+            results = py_.filter(results, lambda it: len(it["missing"]) < len(it["constraint"]))
         else:
-            return py_.filter(results, lambda it: len(it["missing"]) == 0)
+            results = py_.filter(results, lambda it: len(it["missing"]) == 0)
+
+        return results if self.top_k is None else results[:self.top_k]
+
+
+def _constraint_doc(items: Dict[str, Any]) -> str:
+    return " ".join(value for value in items.values() if value is not None)
 
 
 class RankConstraints(Node):
     """
     Rank constraints using some heuristics
     NOTE: We are not giving priority to lengths
+
+    By default, tf-idf weights are fit on the constraints being ranked in each
+    call. Pass the full list of `constraints` to fit them once, up front. The
+    score of each constraint is then just looked up.
     """
 
+    def __init__(self, constraints: List[Constraint] = None):
+        self.precomputed = constraints is not None
+        self.vectorizer = None
+        self.doc_scores: Dict[str, float] = {}
+
+        if self.precomputed:
+            self._fit(constraints)
+
+    def _fit(self, constraints: List[Constraint]):
+        docs = [_constraint_doc(c["items"]) for c in constraints]
+        try:
+            vectorizer = TfidfVectorizer()
+            tf = vectorizer.fit_transform(docs)
+        except ValueError:
+            # Nothing to weigh, like when all the values are stop words
+            return
+
+        self.vectorizer = vectorizer
+        self.doc_scores = dict(zip(docs, tf.sum(axis=1).A1))
+
+    def _precomputed_scores(self, docs: List[str]) -> List[float]:
+        """
+        Scores for the docs using the weights fit up front. Docs not seen
+        then are scored on the fly.
+        """
+
+        unseen = [doc for doc in docs if doc not in self.doc_scores]
+        extra: Dict[str, float] = {}
+        if unseen and self.vectorizer is not None:
+            extra = dict(zip(unseen, self.vectorizer.transform(unseen).sum(axis=1).A1))
+
+        return [self.doc_scores.get(doc, extra.get(doc, 0.0)) for doc in docs]
+
     def _disambiguate(self, ranked, tf_scores):
         """
         Order items based on match importance,
@@ -102,9 +233,13 @@ class RankConstraints(Node):
         return output
 
     def eval(self, constraints: ConstraintSearch):
+        docs = [_constraint_doc(c["constraint"]) for c in constraints.value]
+
+        if self.precomputed:
+            return self._disambiguate(constraints.value, self._precomputed_scores(docs))
+
         try:
-            tf = TfidfVectorizer().fit_transform([" ".join(c["constraint"].values()) for c in constraints.value])
-            tf_scores = tf.todense().sum(axis=1)
-            return self._disambiguate(constraints.value, tf_scores)
+            tf = TfidfVectorizer().fit_transform(docs)
+            return self._disambiguate(constraints.value, tf.sum(axis=1).A1)
         except ValueError:
             return constraints.value
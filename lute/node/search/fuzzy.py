@@ -0,0 +1,159 @@
+"""
+Approximate search over lists of words/phrases
+"""
+
+from typing import Dict, List, Set, Tuple
+
+from lute.node import Node
+from lute.node.search.generic import TOKEN, Range
+
+
+def normalize(text: str) -> str:
+    """
+    Lowercase the text and keep only its tokens, separated by single spaces.
+    """
+
+    return " ".join(token.lower() for token in TOKEN.findall(text))
+
+
+def deletes(word: str, max_distance: int) -> Set[str]:
+    """
+    Return all the strings made by deleting up to `max_distance` characters from
+    the word, including the word itself.
+    """
+
+    found = {word}
+    frontier = {word}
+    for _ in range(max_distance):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+        found |= frontier
+
+    return found
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """
+    Optimal string alignment distance (Levenshtein distance with transpositions
+    of adjacent characters) between the strings. Anything above `max_distance`
+    is returned as `max_distance + 1`.
+    """
+
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    prev_prev: List[int] = []
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(prev[j] + 1, current[j - 1] + 1, prev[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], prev_prev[j - 2] + 1)
+
+        if min(current) > max_distance:
+            return max_distance + 1
+
+        prev_prev, prev = prev, current
+
+    return min(prev[-1], max_distance + 1)
+
+
+class FuzzySearch(Node):
+    """
+    Search for terms allowing up to `max_distance` edits (insertions, deletions,
+    substitutions and transpositions of characters), like for misspelled
+    entities in ASR transcripts. Matching is case insensitive and on whole
+    tokens, so splitting or joining words counts as an edit too.
+
+    Terms are indexed by all their forms with up to `max_distance` characters
+    deleted (like in SymSpell). Phrases from the text are looked up by their
+    deleted forms, so query time doesn't grow with the number of terms. Terms
+    shorter than `min_length` characters are only matched exactly.
+
+    Results have the edit `distance` along with the usual keys.
+    """
+
+    def __init__(self, terms: List[str], max_distance: int = 1, min_length: int = 4, lang: str = "en"):
+        self.terms = terms
+        self.max_distance = max_distance
+        self.min_length = min_length
+        self.lang = lang
+        self.search_type = "fuzzy"
+        self._prepare_index()
+
+    def _prepare_index(self):
+        self.normalized = [normalize(term) for term in self.terms]
+        self.exact: Dict[str, List[int]] = {}
+        self.index: Dict[str, List[int]] = {}
+        self.max_tokens = 0
+
+        for idx, norm in enumerate(self.normalized):
+            if not norm:
+                continue
+
+            self.max_tokens = max(self.max_tokens, norm.count(" ") + 1)
+            self.exact.setdefault(norm, []).append(idx)
+            if len(norm) >= self.min_length:
+                for form in deletes(norm, self.max_distance):
+                    self.index.setdefault(form, []).append(idx)
+
+    def _lookup(self, phrase: str) -> Dict[int, int]:
+        """
+        Return distances of terms close to the (normalized) phrase, keyed by term
+        index.
+        """
+
+        found = {idx: 0 for idx in self.exact.get(phrase, [])}
+        if len(phrase) + self.max_distance < self.min_length:
+            return found
+
+        checked = set(found)
+        for form in deletes(phrase, self.max_distance):
+            for idx in self.index.get(form, []):
+                if idx in checked:
+                    continue
+
+                checked.add(idx)
+                distance = edit_distance(phrase, self.normalized[idx], self.max_distance)
+                if distance <= self.max_distance:
+                    found[idx] = distance
+
+        return found
+
+    def _find(self, text: str) -> List[Tuple[int, Range, int]]:
+        """
+        Return (term index, range, distance) for hits in the text. Phrases span
+        up to `max_distance` more tokens than the longest term since each extra
+        space is an edit. For each term, the closest hits not overlapping each
+        other are kept.
+        """
+
+        tokens = [(m.group().lower(), m.start(), m.end()) for m in TOKEN.finditer(text)]
+        window = self.max_tokens + self.max_distance
+
+        hits = []
+        for i, (phrase, start, _) in enumerate(tokens):
+            for j in range(i, min(i + window, len(tokens))):
+                if j > i:
+                    phrase += " " + tokens[j][0]
+
+                for idx, distance in self._lookup(phrase).items():
+                    hits.append((distance, start, tokens[j][2], idx))
+
+        kept: Dict[int, List[Range]] = {}
+        results = []
+        for distance, start, end, idx in sorted(hits):
+            ranges = kept.setdefault(idx, [])
+            if all(end <= s or e <= start for s, e in ranges):
+                ranges.append((start, end))
+                results.append((idx, (start, end), distance))
+
+        return sorted(results)
+
+    def eval(self, text: Node):
+        return [{
+            "type": self.search_type,
+            "value": self.terms[idx],
+            "range": rng,
+            "distance": distance
+        } for idx, rng, distance in self._find(text.value)]
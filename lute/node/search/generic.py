@@ -2,15 +2,29 @@
 Generic search handler
 """
 
-from typing import Any, Dict, List, Tuple, Union
+import gc
+import os
+import pickle
+import tempfile
+import warnings
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
 import regex as re
 from lute.node import Node
+from lute.node.search.trie import Automaton, Trie
+from lute.utils import hash_values
 from pydash import py_
 
 Pattern = Union[str, List[str]]
 Range = Tuple[int, int]
 
+WORD_BOUNDARY = re.compile(r"\b")
+TOKEN = re.compile(r"\w+", re.UNICODE)
+
+# Bump this whenever the matcher state kept by the search nodes changes
+ARTIFACT_VERSION = 4
+
 
 def make_optional_pattern(items: List[str], word_break=True):
     if word_break:
@@ -19,21 +33,102 @@ def make_optional_pattern(items: List[str], word_break=True):
         return re.compile(r"((" + r")|(".join(items) + r"))", re.I | re.UNICODE)
 
 
+def drop_overlaps(hits: Iterable[Tuple[int, Range]]) -> List[Tuple[int, Range]]:
+    """
+    Sort (term index, range) hits and drop the ones overlapping an earlier hit of
+    the same term, like they would be when searching for the term separately.
+    """
+
+    last_end: Dict[int, int] = {}
+    filtered = []
+
+    for idx, (start, end) in sorted(hits):
+        if start >= last_end.get(idx, 0):
+            last_end[idx] = end
+            filtered.append((idx, (start, end)))
+
+    return filtered
+
+
+def pick_forms(hits: Iterable[Tuple[Tuple[int, int], int, int]]) -> List[Tuple[int, Range]]:
+    """
+    Take ((term index, form rank), start, end) hits of literal forms and keep,
+    like a regex alternation would, only the earliest form of a term matching
+    at a position. Then drop overlapping hits like `drop_overlaps`.
+    """
+
+    best: Dict[Tuple[int, int], Tuple[int, int]] = {}
+    for (idx, rank), start, end in hits:
+        if (idx, start) not in best or rank < best[(idx, start)][0]:
+            best[(idx, start)] = (rank, end)
+
+    return drop_overlaps((idx, (start, end)) for (idx, start), (_, end) in best.items())
+
+
+class _Boundaries:
+    """
+    Word boundary positions of the text, checked only when asked for. This is
+    cheaper than listing all of them when few positions are looked up.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def __contains__(self, pos: int) -> bool:
+        return WORD_BOUNDARY.match(self.text, pos) is not None
+
+
 class ExpansionSearch(Node):
     """
     Class for expansion based search
+
+    The `engine` decides how the text is scanned:
+
+    1. `term` runs a regex for each term separately.
+    2. `combined` finds all the expansions in one scan of the text with an
+       Aho-Corasick automaton. This needs literal expansions (`regex=False`)
+       and time taken only depends on the length of the text and the number
+       of hits. With a few dozen terms, `term` is faster still.
+    3. `trie` looks up the expansions in a character trie, walking the text
+       from each word boundary. This also needs literal expansions and its
+       speed doesn't depend on the number of expansions, so it suits very
+       large lists.
+    4. `token` looks up sequences of tokens (`\\w+`) of the text in a hash map of
+       the expansions' tokens. This also needs literal expansions and only the
+       tokens are compared, so `New York` matches `new-york` too. Forms with
+       leading or trailing non-word characters (like `c++`) can't be matched
+       this way and are skipped with a warning. Time taken depends on the
+       number of tokens in the text and in the longest expansion.
+
+    With an `artifact_dir`, the prepared matcher (compiled regexes, automaton
+    or trie) is saved there in a file keyed by a hash of the terms, expansions
+    and options. Later nodes with the same inputs load it instead of preparing
+    the matcher again.
     """
 
-    def __init__(self, terms: List[str], exp: Dict, lang: str = "en", regex=True):
+    def __init__(self, terms: List[str], exp: Dict, lang: str = "en", regex=True, engine="term",
+                 artifact_dir: str = None):
         self.terms = terms
         self.exp = exp
         self.lang = lang
+        self.engine = engine
+        self.artifact_dir = artifact_dir
         self.search_type = "expansion"
+        self.literals = None
         self._validate_expansions()
+
+        artifact_path = self._artifact_path(regex)
+        if artifact_path is not None and self._load_artifact(artifact_path):
+            return
+
         if regex is False:
+            self.literals = {term: list(self.exp[term]) for term in self.terms}
             self._escape_expansions()
         self._prepare_matcher()
 
+        if artifact_path is not None:
+            self._save_artifact(artifact_path)
+
     def _validate_expansions(self):
         """
         Check if all the terms are in the expansion dict
@@ -59,38 +154,234 @@ class ExpansionSearch(Node):
         Precompile regex for the relevant expansions
         """
 
-        self.re_patterns = {}
-        for term in self.terms:
-            self.re_patterns[term] = make_optional_pattern(self.exp[term])
+        if self.engine == "term":
+            self.re_patterns = {}
+            for term in self.terms:
+                self.re_patterns[term] = make_optional_pattern(self.exp[term])
+        elif self.engine == "combined":
+            if self.literals is None:
+                raise ValueError("combined engine needs literal expansions, set regex=False")
+
+            self.automaton = Automaton((form, (idx, rank))
+                                       for idx, term in enumerate(self.terms)
+                                       for rank, form in enumerate(self.literals[term]))
+        elif self.engine == "trie":
+            if self.literals is None:
+                raise ValueError("trie engine needs literal expansions, set regex=False")
+
+            self.trie = Trie()
+            for idx, term in enumerate(self.terms):
+                for rank, form in enumerate(self.literals[term]):
+                    self.trie.add(form, (idx, rank))
+        elif self.engine == "token":
+            if self.literals is None:
+                raise ValueError("token engine needs literal expansions, set regex=False")
+
+            self.phrases: Dict[Tuple[str, ...], List[Tuple[int, int]]] = {}
+            skipped = []
+            for idx, term in enumerate(self.terms):
+                for rank, form in enumerate(self.literals[term]):
+                    tokens = list(TOKEN.finditer(form.strip()))
+                    # Hits only span the tokens, so a form like `c++` would match
+                    # a bare `c` and get a range short of the literal
+                    if not tokens or tokens[0].start() > 0 or tokens[-1].end() < len(form.strip()):
+                        skipped.append(form)
+                        continue
+                    key = tuple(m.group().lower() for m in tokens)
+                    self.phrases.setdefault(key, []).append((idx, rank))
+
+            if skipped:
+                warnings.warn("token engine skips forms not starting and ending with a token: {}. "
+                              "Use another engine for these".format(", ".join(skipped)))
+
+            self.max_phrase_len = max((len(key) for key in self.phrases), default=0)
+        else:
+            raise ValueError("Unknown search engine {}".format(self.engine))
+
+    def _matcher_state(self) -> Dict[str, Any]:
+        """
+        Attributes making up the prepared matcher.
+        """
+
+        attrs = ["exp", "literals"] + {
+            "term": ["re_patterns"],
+            "combined": ["automaton"],
+            "trie": ["trie"],
+            "token": ["phrases", "max_phrase_len"]
+        }[self.engine]
+
+        return {attr: getattr(self, attr) for attr in attrs}
+
+    def _artifact_path(self, regex: bool) -> Optional[str]:
+        if self.artifact_dir is None:
+            return None
+
+        key = hash_values([ARTIFACT_VERSION, self.engine, regex, self.terms,
+                           [self.exp[term] for term in self.terms]])
+        return os.path.join(self.artifact_dir, "matcher-{}.pkl".format(key))
+
+    def _load_artifact(self, path: str) -> bool:
+        """
+        Set the matcher from a saved artifact, returning False if that's not
+        possible.
+        """
+
+        # Loading creates lots of containers (like trie nodes) and pausing the
+        # garbage collector in between makes it a few times faster
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(path, "rb") as fp:
+                artifact = pickle.load(fp)
+        except Exception:
+            # Missing or broken artifacts are just rebuilt (and overwritten)
+            return False
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        if artifact.get("version") != ARTIFACT_VERSION:
+            return False
+
+        self.__dict__.update(artifact["matcher"])
+        return True
+
+    def _save_artifact(self, path: str):
+        """
+        Save the prepared matcher. The file is replaced atomically so that
+        concurrent workers only ever see complete artifacts.
+        """
+
+        try:
+            os.makedirs(self.artifact_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.artifact_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as fp:
+                pickle.dump({"version": ARTIFACT_VERSION, "matcher": self._matcher_state()}, fp, protocol=4)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            warnings.warn("Couldn't save matcher artifact at {}: {}".format(path, e))
 
     def _get_matches(self, term: str, text) -> List[Any]:
         return list(self.re_patterns[term].finditer(text))
 
+    def _get_combined_matches(self, text) -> List[Tuple[int, Range]]:
+        """
+        Return (term index, range) for hits of all terms in one scan with the
+        automaton. Like with the trie, hits are bound by word boundaries and the
+        earliest form of a term matching at a position wins.
+        """
+
+        boundaries = _Boundaries(text)
+        return pick_forms(self.automaton.find_all(text, boundaries, boundaries))
+
+    def _get_trie_matches(self, text) -> List[Tuple[int, Range]]:
+        """
+        Return (term index, range) for hits of all terms using the trie. Hits are
+        bound by word boundaries, like the regexes, and in case many forms of a
+        term match at a position, the earliest form wins.
+        """
+
+        boundaries = {m.start() for m in WORD_BOUNDARY.finditer(text)}
+        return pick_forms(self.trie.find_all(text, sorted(boundaries), boundaries))
+
+    def _get_token_matches(self, text) -> List[Tuple[int, Range]]:
+        """
+        Return (term index, range) for hits of all terms using the token map.
+        Ranges go from the start of the first token to the end of the last.
+        """
+
+        tokens = [(m.group().lower(), m.start(), m.end()) for m in TOKEN.finditer(text)]
+
+        hits = []
+        for i, (_, start, _) in enumerate(tokens):
+            key: Tuple[str, ...] = ()
+            for j in range(i, min(i + self.max_phrase_len, len(tokens))):
+                key += (tokens[j][0],)
+                for value in self.phrases.get(key, []):
+                    hits.append((value, start, tokens[j][2]))
+
+        return pick_forms(hits)
+
+    def _find(self, text: str) -> List[Tuple[str, Range]]:
+        """
+        Return (term, range) for all hits in the text.
+        """
+
+        if self.engine == "combined":
+            return [(self.terms[idx], rng) for idx, rng in self._get_combined_matches(text)]
+        elif self.engine == "trie":
+            return [(self.terms[idx], rng) for idx, rng in self._get_trie_matches(text)]
+        elif self.engine == "token":
+            return [(self.terms[idx], rng) for idx, rng in self._get_token_matches(text)]
+
+        return [(term, m.span()) for term in self.terms for m in self._get_matches(term, text)]
+
+    def _results(self, hits: List[Tuple[str, Range]]) -> List[Dict]:
+        return [{
+            "type": self.search_type,
+            "value": term,
+            "range": (rng[0], rng[1])
+        } for term, rng in hits]
+
+    def _joinable(self) -> bool:
+        """
+        Tell if texts can be searched together, joined by a newline. This is true
+        for literal expansions without newlines, since their hits can't then
+        cross from one text to another. The token engine skips over newlines, so
+        it always works text by text.
+        """
+
+        if self.literals is None or self.engine == "token":
+            return False
+
+        return not any("\n" in form for forms in self.literals.values() for form in forms)
+
     def eval(self, text: Node):
         """
         Search for terms based on expansions
         NOTE: This assume antagonized strings
         """
 
-        results = []
-        for term in self.terms:
-            matches = self._get_matches(term, text.value)
-            results.extend([{
+        return self._results(self._find(text.value))
+
+    def eval_batch(self, text: Node):
+        """
+        Search in a batch of texts. With literal expansions, all the texts are
+        scanned in one go and the hits are mapped back to their texts.
+        """
+
+        texts = text.value
+        if not self._joinable():
+            return [self._results(self._find(t)) for t in texts]
+
+        offsets = []
+        offset = 0
+        for t in texts:
+            offsets.append(offset)
+            offset += len(t) + 1
+
+        results: List[List[Dict]] = [[] for _ in texts]
+        for term, (start, end) in self._find("\n".join(texts)):
+            idx = bisect_right(offsets, start) - 1
+            results[idx].append({
                 "type": self.search_type,
                 "value": term,
-                "range": (m.span()[0], m.span()[1])
-            } for m in matches])
+                "range": (start - offsets[idx], end - offsets[idx])
+            })
 
         return results
 
 
 class ListSearch(ExpansionSearch):
     """
-    Class for searching based on a list of words/phrases
+    Class for searching based on a list of words/phrases. Use `engine="trie"`
+    or `engine="token"` for large lists (like gazetteers), see `ExpansionSearch`
+    for the engines.
     """
 
-    def __init__(self, terms: List[str], lang: str = "en"):
-        super().__init__(terms, self._generate_expansions(terms), lang=lang, regex=False)
+    def __init__(self, terms: List[str], lang: str = "en", engine="term", artifact_dir: str = None):
+        super().__init__(terms, self._generate_expansions(terms), lang=lang, regex=False, engine=engine,
+                         artifact_dir=artifact_dir)
         self.search_type = "list"
 
     def eval(self, text: Node):
@@ -111,30 +402,72 @@ class Canonicalize(Node):
     def _filter_searches(self, searches):
         """
         In case of overlaps, keep the larger result
-        """
 
-        def _overlap_p(res1, res2):
-            first, second = (res1, res2) if res1["range"][0] < res2["range"][0] else (res2, res1)
-            return first["range"][1] >= second["range"][0]
+        Ranges are taken as closed intervals so touching results overlap too.
+        Kept ranges are merged in a sorted list of disjoint spans so that each
+        overlap check is a binary search.
+        """
 
         ordered = sorted(searches, key=lambda res: res["range"][1] - res["range"][0], reverse=True)
 
         filtered = []
         matched = set()
 
+        # Disjoint spans covered by the kept results, sorted by start
+        starts: List[int] = []
+        ends: List[int] = []
+
+        def _overlap_p(start, end):
+            idx = bisect_right(starts, end) - 1
+            return idx >= 0 and ends[idx] >= start
+
+        def _cover(start, end):
+            lo = bisect_left(ends, start)
+            hi = bisect_right(starts, end)
+            if lo < hi:
+                start = min(start, starts[lo])
+                end = max(end, ends[hi - 1])
+            starts[lo:hi] = [start]
+            ends[lo:hi] = [end]
+
         for it in ordered:
-            # NOTE: There are optimizations possible but are not important at the moment
+            start, end = it["range"]
             if self.remove_duplicates and it["value"] in matched:
                 it_copy = it.copy()
                 it_copy["value"] = ""
                 filtered.append(it_copy)
-            elif not any([_overlap_p(it, fit) for fit in filtered]):
+            elif not _overlap_p(start, end):
                 matched.add(it["value"])
                 filtered.append(it)
+            else:
+                continue
+
+            _cover(start, end)
 
         return sorted(filtered, key=lambda res: res["range"][0])
 
     def _mutate(self, text, searches):
+        """
+        Replace ranges of the searches, sorted by start, with their values.
+        """
+
+        pieces = []
+        last_end = 0
+        for search in searches:
+            start, end = search["range"]
+            if start < last_end:
+                # Overlapping ranges (like the ones for removed duplicates) need
+                # splicing with running offsets
+                return self._splice(text, searches)
+
+            pieces.append(text[last_end:start])
+            pieces.append(search["value"])
+            last_end = end
+
+        pieces.append(text[last_end:])
+        return "".join(pieces)
+
+    def _splice(self, text, searches):
         offset = 0
         text = list(text)
         for search in searches:
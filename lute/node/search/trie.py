@@ -0,0 +1,116 @@
+"""
+Character trie and automaton for looking up literal phrases
+"""
+
+from collections import deque
+from typing import Any, Container, Dict, Iterable, Iterator, List, Tuple
+
+_END = ""
+
+
+class Trie:
+    """
+    Case insensitive character trie over phrases. Finding the phrases in a text
+    walks the text once from each start position, so the time taken doesn't
+    grow with the number of phrases.
+    """
+
+    def __init__(self):
+        self.root: Dict[str, Any] = {}
+
+    def add(self, phrase: str, value: Any):
+        """
+        Add a phrase, reporting `value` whenever it is found.
+        """
+
+        node = self.root
+        for char in phrase:
+            node = node.setdefault(char.lower(), {})
+        node.setdefault(_END, []).append(value)
+
+    def find_all(self, text: str, starts: Iterable[int], ends: Container[int]) -> Iterator[Tuple[Any, int, int]]:
+        """
+        Yield (value, start, end) for each phrase in the text which begins at one
+        of the `starts` and stops at one of the `ends` positions.
+        """
+
+        for start in starts:
+            node = self.root
+            for idx in range(start, len(text)):
+                node = node.get(text[idx].lower())
+                if node is None:
+                    break
+
+                if _END in node and idx + 1 in ends:
+                    for value in node[_END]:
+                        yield value, start, idx + 1
+
+
+class Automaton:
+    """
+    Case insensitive Aho-Corasick automaton over phrases. Unlike `Trie`, finding
+    the phrases reads each character of the text once, following failure links
+    when a phrase can't be extended, so the time taken only grows with the
+    length of the text and the number of phrases found.
+    """
+
+    def __init__(self, phrases: Iterable[Tuple[str, Any]]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.outputs: List[List[Tuple[Any, int]]] = [[]]
+
+        for phrase, value in phrases:
+            state = 0
+            for char in phrase:
+                char = char.lower()
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.outputs.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.outputs[state].append((value, len(phrase)))
+
+        self.fail = [0] * len(self.goto)
+        self._link()
+
+    def _link(self):
+        """
+        Set failure links going breadth first, so the state a link points to
+        (being shallower) already has its own. Outputs of that state are phrases
+        ending here too.
+        """
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.outputs[child] = self.outputs[child] + self.outputs[self.fail[child]]
+
+    def find_all(self, text: str, starts: Container[int], ends: Container[int]) -> Iterator[Tuple[Any, int, int]]:
+        """
+        Yield (value, start, end) for each phrase in the text which begins at one
+        of the `starts` and stops at one of the `ends` positions.
+        """
+
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        lowered = text.lower()
+        # Lowering a few characters gives more than one, compare them one by one then
+        chars = lowered if len(lowered) == len(text) else [char.lower() for char in text]
+
+        state = 0
+        for idx, char in enumerate(chars):
+            next_state = goto[state].get(char)
+            while next_state is None and state:
+                state = fail[state]
+                next_state = goto[state].get(char)
+            state = next_state or 0
+
+            if outputs[state] and idx + 1 in ends:
+                for value, length in outputs[state]:
+                    if idx + 1 - length in starts:
+                        yield value, idx + 1 - length, idx + 1
@@ -3,11 +3,11 @@ Some utitlies for nodes
 """
 
 import types
+from collections import deque
 from typing import Callable, List, Union
 
 from lute.exceptions import ResolutionException
 from lute.node import Node
-from pydash import py_
 
 NodeId = Union[str, Node]
 
@@ -77,10 +77,60 @@ def walk_node(node: Node, backward=False) -> List[Node]:
     Walk on the node and return a list of accessible nodes
     """
 
-    neighbours = node.predecessors if backward else node.successors
-    accessible = neighbours.copy()
+    return walk_nodes([node], backward=backward)
 
-    for node in neighbours:
-        accessible += walk_node(node, backward=backward)
 
-    return py_.uniq(accessible)
+def walk_nodes(nodes: List[Node], backward=False) -> List[Node]:
+    """
+    Walk from all the given nodes together and return a list of nodes accessible
+    from any of them. Each node is visited once so this is linear in the size of
+    the reachable graph.
+    """
+
+    accessible = []
+    seen = set()
+    expanded = set(nodes)
+    todo = deque(nodes)
+
+    while todo:
+        current = todo.popleft()
+        for neighbour in (current.predecessors if backward else current.successors):
+            if neighbour not in seen:
+                seen.add(neighbour)
+                accessible.append(neighbour)
+                if neighbour not in expanded:
+                    expanded.add(neighbour)
+                    todo.append(neighbour)
+
+    return accessible
+
+
+def topological_sort(nodes: List[Node]) -> List[Node]:
+    """
+    Return the given nodes, along with everything they depend on, ordered so that
+    each node comes after all its predecessors. The order is the same as the one
+    followed by recursive `value` calls on the nodes.
+    """
+
+    order = []
+    visited = set()
+
+    for root in nodes:
+        if root in visited:
+            continue
+
+        visited.add(root)
+        stack = [(root, iter(root.predecessors))]
+
+        while stack:
+            node, preds = stack[-1]
+            for pred in preds:
+                if pred not in visited:
+                    visited.add(pred)
+                    stack.append((pred, iter(pred.predecessors)))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+
+    return order
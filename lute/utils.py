@@ -1,5 +1,23 @@
+import hashlib
+import pickle
+from typing import Any, Optional
+
+
 def clip_to_len(text: str, maxlen: int, end="...") -> str:
     if len(text) <= maxlen:
         return text
     else:
         return text[:(maxlen - len(end))] + end
+
+
+def hash_values(values: Any) -> Optional[str]:
+    """
+    Return a hash of the values using their pickled bytes. This is stable across
+    processes for plain data (but not for things like sets of strings, whose
+    iteration order changes). Return None if the values can't be pickled.
+    """
+
+    try:
+        return hashlib.blake2b(pickle.dumps(values, protocol=4), digest_size=20).hexdigest()
+    except Exception:
+        return None
@@ -2,8 +2,17 @@
 Tests for graphs
 """
 
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
 from lute.graph import Graph
-from lute.node import Constant, GraphNode, Identity, Variable
+from lute.node import Constant, Frame, GraphNode, Identity, Node, Variable
+from lute.node.fn import node_fn
+from lute.node.utils import mute
 
 
 def test_run():
@@ -71,3 +80,322 @@ def test_clone():
     assert g.run(10) == [12, 2]
     assert [n.value for n in gc.outputs] == [35, 2]
     assert [n.value for n in g.outputs] == [12, 2]
+
+
+def test_deep_chain():
+    x = Variable()
+    y = x
+    for _ in range(5000):
+        y = Identity()(y)
+
+    g = Graph(x, y)
+    assert g.run(3) == 3
+    assert g.run("hello") == "hello"
+
+
+def test_plan():
+    x = Variable()
+    y = Identity()(x)
+    dangling = Identity()(x)
+
+    g = Graph(x, Identity()(y))
+
+    assert g._plan.order == [x, y, g.outputs[0]]
+    assert g.run(1) == 1
+    assert not dangling.evaluated
+
+
+def test_frame():
+    x = Variable()
+    y = Constant(2)
+    z = x + y
+
+    g = Graph(x, [z, y])
+    frame = Frame()
+
+    assert g.run(33, frame=frame) == [35, 2]
+    assert frame[z] == 35
+    assert not z.evaluated
+    assert not x.evaluated
+
+    sg = Graph(x, GraphNode(g)(x))
+    assert sg.run(1, frame=Frame()) == [3, 2]
+    assert not z.evaluated
+
+
+class Upper(Node):
+    def eval(self, a):
+        return a.value.upper()
+
+
+def test_frame_threads():
+    class Sleepy(Node):
+        def eval(self, a):
+            time.sleep(0.01)
+            return a.value * 2
+
+    x = Variable()
+    g = Graph(x, Identity()(Sleepy()(x)) + Constant(1))
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda i: g.run(i, frame=Frame()), range(64)))
+
+    assert results == [2 * i + 1 for i in range(64)]
+
+
+def test_nested_run():
+    w = Variable()
+    inner = Graph(w, Identity()(w))
+    upper = node_fn(Upper())
+
+    class Words(Node):
+        def eval(self, text):
+            return [inner.run(word) for word in text.value.split()] + [upper("d")]
+
+    x = Variable()
+    g = Graph(x, Identity()(Words()(x)))
+    expected = ["a", "b", "c", "D"]
+
+    assert g.run("a b c") == expected
+    assert g.run("a b c", frame=Frame()) == expected
+    assert asyncio.run(g.arun("a b c")) == expected
+    assert g.run_batch(["a b c"]) == [expected]
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        assert g.run("a b c", executor=pool) == expected
+
+
+def test_parallel_run():
+    # Only lets the branches through once all four are running at once
+    barrier = threading.Barrier(4, timeout=5)
+
+    class Waiting(Node):
+        def eval(self, a):
+            barrier.wait()
+            return a.value
+
+    x = Variable()
+    branches = [Waiting()(x) for _ in range(4)]
+    out = branches[0] + branches[1] + branches[2] + branches[3]
+    g = Graph(x, [out, branches[0]])
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        assert g.run([1], executor=pool) == [[1, 1, 1, 1], [1]]
+
+    assert not out.evaluated
+
+
+def test_parallel_run_error():
+    class Failing(Node):
+        def eval(self, a):
+            raise ValueError(a.value)
+
+    x = Variable()
+    g = Graph(x, Identity()(Failing()(x)))
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        with pytest.raises(ValueError):
+            g.run(1, executor=pool)
+
+
+class AsyncSleepy(Node):
+    async def eval(self, a):
+        await asyncio.sleep(0.2)
+        return a.value
+
+
+def test_arun():
+    running = set()
+    overlaps = []
+
+    class Tracked(Node):
+        async def eval(self, a):
+            running.add(self)
+            await asyncio.sleep(0.01)
+            overlaps.append(len(running))
+            running.discard(self)
+            return a.value
+
+    x = Variable()
+    branches = [Tracked()(x) for _ in range(4)]
+    out = Identity()(branches[0] + branches[1]) + branches[2] + branches[3]
+    g = Graph(x, out)
+
+    assert asyncio.run(g.arun([1])) == [1, 1, 1, 1]
+    # All the branches were awaited together
+    assert max(overlaps) == 4
+
+    with pytest.raises(RuntimeError):
+        g.run([1])
+
+
+def test_arun_executor():
+    x = Variable()
+    g = Graph(x, [Identity()(AsyncSleepy()(x)), x + Constant(1)])
+
+    async def _run_all():
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            return await asyncio.gather(*[g.arun(i, executor=pool) for i in range(10)])
+
+    assert asyncio.run(_run_all()) == [[i, i + 1] for i in range(10)]
+
+
+def test_run_batch():
+    class Square(Node):
+        calls = 0
+
+        def eval(self, a):
+            return a.value ** 2
+
+        def eval_batch(self, a):
+            Square.calls += 1
+            return [v ** 2 for v in a.value]
+
+    class Negate(Node):
+        def eval(self, a):
+            return -a.value
+
+    x = Variable()
+    y = Variable()
+    sq = Square()(x)
+    g = Graph([x, y], [Negate()(sq) + y, Identity()(sq)])
+    batch = [[i, 2 * i] for i in range(10)]
+
+    assert g.run_batch(batch) == [g.run(ip) for ip in batch]
+    assert Square.calls == 1
+
+    g = Graph(x, Negate()(x) + Constant(1))
+    assert g.run_batch([1, 2, 3]) == [0, -1, -2]
+
+    # Patched eval is used over the class's eval_batch
+    sq = Square()(x)
+    mute(sq)
+    g = Graph(x, sq)
+    assert g.run_batch([1, 2, 3]) == [1, 2, 3]
+
+
+class Keys(Node):
+    def eval(self, a):
+        return sorted(a.value)
+
+
+def test_incremental():
+    class Counted(Node):
+        def __init__(self):
+            self.calls = 0
+
+        def eval(self, a):
+            self.calls += 1
+            return a.value
+
+    x = Variable()
+    ctx = Variable()
+    cx = Counted()(x)
+    cctx = Counted()(ctx)
+    cc = Counted()(Constant(2))
+    g = Graph([x, ctx], [cx + cctx, cc], incremental=True)
+
+    assert g.run(1, 10) == [11, 2]
+    assert g.run(2, 10) == [12, 2]
+    assert g.run(3, 10) == [13, 2]
+    assert (cx.calls, cctx.calls, cc.calls) == (3, 1, 1)
+
+    assert g.run(3, 20) == [23, 2]
+    assert (cx.calls, cctx.calls, cc.calls) == (3, 2, 1)
+
+    g.clear()
+    assert g.run(3, 20) == [23, 2]
+    assert (cx.calls, cctx.calls, cc.calls) == (4, 3, 2)
+
+    # Inputs mutated in place between runs are seen as changed
+    ctx_value = {"a": 1}
+    g = Graph([x, ctx], [cx, Identity()(Keys()(ctx))], incremental=True)
+    assert g.run(1, ctx_value) == [1, ["a"]]
+    ctx_value["b"] = 2
+    assert g.run(1, ctx_value) == [1, ["a", "b"]]
+    assert g.run(1, ctx_value) == [1, ["a", "b"]]
+    assert cx.calls == 5
+
+
+def test_run_outputs():
+    x = Variable()
+    a = Identity(name="a")(x)
+    b = Identity(name="b")(x + Constant(1))
+    g = Graph(x, [a, b])
+
+    assert g.run(1, outputs=["a"]) == 1
+    assert not b.evaluated
+    assert g.run(1, outputs=[b, a]) == [2, 1]
+    assert g.run(2, outputs=b, frame=Frame()) == 3
+    assert g.run_batch([1, 2], outputs="b") == [2, 3]
+    assert len(g._output_plans) == 4
+
+    g = Graph(x, [a, b], incremental=True)
+    assert g.run(1, outputs="a") == 1
+    assert g.run(2, outputs="b") == 3
+    assert g.run(2, outputs="a") == 2
+
+
+class Watched(Identity):
+    """
+    Identity counting the reads of its edges.
+    """
+
+    reads = 0
+
+    @property
+    def successors(self):
+        Watched.reads += 1
+        return self._successors
+
+    @successors.setter
+    def successors(self, value):
+        self._successors = value
+
+    @property
+    def predecessors(self):
+        Watched.reads += 1
+        return self._predecessors
+
+    @predecessors.setter
+    def predecessors(self, value):
+        self._predecessors = value
+
+
+def test_large_graph():
+    x = Variable()
+    y = x
+    for _ in range(2000):
+        y = Watched()(y) + Watched()(y)
+
+    Watched.reads = 0
+    g = Graph(x, y)
+    # Indexing reads the edges of each node a few times, not once per path
+    assert Watched.reads <= 10 * 4000
+
+    assert len(g._nodes) == 6001
+    assert g.run(1) == 2 ** 2000
+
+
+def test_release():
+    x = Variable()
+    a = Identity(name="a")(x)
+    b = Identity(name="b")(a + a)
+    c = b + a
+    g = Graph(x, c)
+
+    frame = Frame()
+    assert g.run(1, frame=frame) == 3
+    assert set(frame.values) == {c}
+
+    g.pin("b")
+    frame = Frame()
+    assert g.run(1, frame=frame) == 3
+    assert set(frame.values) == {b, c}
+    assert frame[b] == 2
+
+    assert g.run_batch([1, 2]) == [3, 6]
+    assert asyncio.run(g.arun(2)) == 6
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        frame = Frame()
+        assert g.run(2, frame=frame, executor=pool) == 6
+        assert set(frame.values) == {b, c}
@@ -0,0 +1,141 @@
+"""
+Tests for batch evaluation
+"""
+
+import os
+import time
+
+import pytest
+
+from lute.exceptions import BatchEvalException
+from lute.graph import Graph
+from lute.graph.batch import _dedupe, batch_eval, stream_eval
+from lute.node import Constant, Node, Variable
+
+
+class Sqrt(Node):
+    def eval(self, a):
+        if a.value < 0:
+            raise ValueError("negative input")
+        return a.value ** 0.5
+
+
+class Touch(Node):
+    def __init__(self, path):
+        self.path = path
+
+    def eval(self, a):
+        if a.value == 0:
+            raise ValueError("first input")
+        open(os.path.join(self.path, str(a.value)), "w").close()
+        time.sleep(0.01)
+        return a.value
+
+
+def make_graph():
+    x = Variable()
+    return Graph(x, Sqrt()(x) + Constant(1))
+
+
+def test_batch():
+    g = make_graph()
+    batch = list(range(100))
+
+    assert batch_eval(g, batch) == [i ** 0.5 + 1 for i in batch]
+    assert batch_eval(g, batch, workers=2, chunksize=8) == [i ** 0.5 + 1 for i in batch]
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_batch_errors(workers):
+    g = make_graph()
+
+    if workers is None:
+        with pytest.raises(ValueError):
+            batch_eval(g, [1, 4, -1, 9])
+    else:
+        with pytest.raises(BatchEvalException) as e:
+            batch_eval(g, [1, 4, -1, 9], workers=workers)
+        assert e.value.index == 2
+        assert isinstance(e.value.error, ValueError)
+
+    outputs = batch_eval(g, [1, 4, -1, 9], workers=workers, return_exceptions=True)
+    assert outputs[:2] == [2, 3]
+    assert isinstance(outputs[2], ValueError)
+    assert outputs[3] == 4
+
+
+def test_batch_errors_cancel(tmp_path):
+    x = Variable()
+    g = Graph(x, Touch(str(tmp_path))(x))
+
+    with pytest.raises(BatchEvalException) as e:
+        batch_eval(g, list(range(200)), workers=2)
+    assert e.value.index == 0
+    # Items not started when the error came up are dropped
+    assert len(os.listdir(tmp_path)) < 100
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_stream(workers):
+    g = make_graph()
+    pulled = []
+
+    def _inputs():
+        for i in range(50):
+            pulled.append(i)
+            yield i
+
+    outputs = stream_eval(g, _inputs(), batch_size=4, workers=workers, window=2)
+    assert next(outputs) == 1
+    assert len(pulled) < 50
+    assert [1] + list(outputs) == [i ** 0.5 + 1 for i in range(50)]
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_dedupe(workers):
+    g = make_graph()
+    batch = [4, 9, 4, 4, 16, 9, 1, 4]
+
+    stats = {}
+    assert batch_eval(g, batch, workers=workers, dedupe=True, stats=stats) == [b ** 0.5 + 1 for b in batch]
+    assert stats == {"items": 8, "unique": 4, "dedupe_ratio": 0.5}
+
+    if workers is None:
+        with pytest.raises(ValueError):
+            batch_eval(g, [1, 1, 4, -1, -1], dedupe=True)
+    else:
+        with pytest.raises(BatchEvalException) as e:
+            batch_eval(g, [1, 1, 4, -1, -1], workers=workers, dedupe=True)
+        assert e.value.index == 3
+
+    outputs = batch_eval(g, [1, 1, -1, 4, -1], workers=workers, return_exceptions=True, dedupe=True)
+    assert outputs[:2] == [2, 2] and outputs[3] == 3
+    assert isinstance(outputs[2], ValueError) and outputs[4] is outputs[2]
+
+    stats = {}
+    outputs = stream_eval(g, iter(batch), batch_size=4, workers=workers, dedupe=True, stats=stats)
+    assert list(outputs) == [b ** 0.5 + 1 for b in batch]
+    assert stats == {"items": 8, "unique": 6, "dedupe_ratio": 0.25}
+
+
+def test_dedupe_calls():
+    calls = []
+
+    class Logged(Node):
+        def eval(self, a):
+            calls.append(a.value)
+            return a.value
+
+    x = Variable()
+    g = Graph(x, Sqrt()(Logged()(x)))
+    batch = [4, 9, 4, 4, 16, 9, 1, 4]
+
+    assert batch_eval(g, batch, dedupe=True) == [b ** 0.5 for b in batch]
+    assert sorted(calls) == [1, 4, 9, 16]
+
+
+def test_dedupe_keys():
+    # Equal items of different types, at any depth, aren't merged
+    assert _dedupe([1, True, 1.0, 1]) == ([1, True, 1.0], [0, 1, 2, 0])
+    assert _dedupe([("a", 1), ("a", True), (1,), (1.0,), ("a", 1)])[1] == [0, 1, 2, 3, 0]
+    assert _dedupe([[1], [True], [1]])[1] == [0, 1, 0]
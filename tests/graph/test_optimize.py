@@ -0,0 +1,85 @@
+"""
+Tests for graph optimization passes
+"""
+
+import pickle
+
+from lute.graph import Graph
+from lute.graph.batch import batch_eval
+from lute.graph.optimize import fold_constants, merge_duplicates
+from lute.node import Constant, Identity, Node, Variable
+from lute.node.search import Canonicalize, ListSearch
+
+
+class Counted(Node):
+    calls = 0
+
+    def eval(self, a):
+        Counted.calls += 1
+        return sorted(a.value)
+
+
+def test_fold_constants():
+    x = Variable()
+    lexicon = Counted()(Constant(["b", "a"]) + Constant(["c"]))
+    lookup = Identity()(lexicon)
+    out = x + lookup
+    g = fold_constants(Graph(x, [out, lexicon]))
+
+    assert Counted.calls == 1
+    assert g.run(["z"]) == [["z", "a", "b", "c"], ["a", "b", "c"]]
+    assert g.run(["y"]) == [["y", "a", "b", "c"], ["a", "b", "c"]]
+    assert Counted.calls == 1
+
+    assert lookup.fan_in == 0
+    assert g._plan.order == [x, lookup, out, lexicon]
+
+    assert g.run_batch([["z"], ["y"]]) == [
+        [["z", "a", "b", "c"], ["a", "b", "c"]],
+        [["y", "a", "b", "c"], ["a", "b", "c"]]
+    ]
+
+    # Folded BinOps don't go through the class's eval_batch
+    g = fold_constants(Graph(x, x + (Constant([1]) + Constant([2]))))
+    assert g.run_batch([[0], [3]]) == [[0, 1, 2], [3, 1, 2]]
+
+    # Folded graphs can go to worker processes
+    assert pickle.loads(pickle.dumps(g)).run([3]) == [3, 1, 2]
+    assert batch_eval(g, [[0], [3]], workers=2) == [[0, 1, 2], [3, 1, 2]]
+
+
+def test_merge_duplicates():
+    x = Variable()
+    s1 = ListSearch(["venus", "blue moon"])(x)
+    s2 = ListSearch(["venus", "blue moon"])(x)
+    s3 = ListSearch(["venus"])(x)
+    c1 = Canonicalize()(x, s1)
+    c2 = Canonicalize()(x, s2)
+
+    g = merge_duplicates(Graph(x, [c1, c2, s3]))
+
+    assert s2.merged_into is s1
+    assert c2.merged_into is c1
+    assert not hasattr(s3, "merged_into")
+
+    assert g.run("hello venus") == [
+        "hello venus", "hello venus",
+        [{"type": "list", "value": "venus", "range": (6, 11)}]
+    ]
+    assert c2.predecessors == [c1]
+    assert s1.successors == [c1, s2]
+
+    assert g.run_batch(["hello venus", "blue moon"]) == [
+        ["hello venus", "hello venus", [{"type": "list", "value": "venus", "range": (6, 11)}]],
+        ["blue moon", "blue moon", []]
+    ]
+
+    x = Variable()
+    s1 = ListSearch(["venus"])(x)
+    s2 = ListSearch(["venus"])(x)
+    g = merge_duplicates(Graph(x, [s1, s2]))
+    hits = [{"type": "list", "value": "venus", "range": (0, 5)}]
+    assert g.run_batch(["venus", "mars"]) == [[hits, hits], [[], []]]
+
+    assert pickle.loads(pickle.dumps(g)).run("venus") == [hits, hits]
+    assert batch_eval(g, ["venus", "mars"], workers=2) == [[hits, hits], [[], []]]
@@ -0,0 +1,219 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+
+import pytest
+
+from lute.graph import Graph
+from lute.node import Frame, Node, Variable
+from lute.node.cache import DiskCache, LRUCache
+
+
+class Counted(Node):
+    def __init__(self):
+        self.calls = 0
+
+    def eval(self, a):
+        self.calls += 1
+        return a.value.upper()
+
+
+def test_node_cache():
+    x = Variable()
+    c = Counted(cache=LRUCache())(x)
+    g = Graph(x, c)
+
+    for text in ["yes", "no", "yes", "yes", "no"]:
+        assert g.run(text) == text.upper()
+
+    assert g.run("no", frame=Frame()) == "NO"
+    assert c.calls == 2
+    assert (c.cache.hits, c.cache.misses) == (4, 2)
+
+
+class Lower(Node):
+    def eval(self, a):
+        return a.value.lower()
+
+
+class Scale(Node):
+    def __init__(self, k):
+        self.k = k
+
+    def eval(self, a):
+        return a.value * self.k
+
+
+def test_cache_params():
+    x = Variable()
+    s = Scale(2, cache=LRUCache())(x)
+    g = Graph(x, s)
+
+    assert g.run(3) == 6
+    g.set_param("k", 10)
+    assert g.run(3) == 30
+    assert (s.cache.hits, s.cache.misses) == (0, 2)
+
+    g.set_param("k", 10)
+    assert g.run(3) == 30
+    assert (s.cache.hits, s.cache.misses) == (1, 2)
+
+
+class Add(Node):
+    def eval(self, a, b):
+        return a.value + (b.value if isinstance(b, Node) else b)
+
+
+class Select(Node):
+    def eval(self, **kwargs):
+        return sorted(kwargs)[0]
+
+
+class Locked(Node):
+    def __init__(self, lock=None):
+        self.lock = lock or threading.Lock()
+
+    def eval(self, a):
+        with self.lock:
+            return a.value
+
+
+def test_cache_keys():
+    shared = LRUCache()
+    x = Variable()
+    g = Graph(x, [Add(cache=shared)(x, 1), Add(cache=shared)(x, 100), Add(cache=shared)(x, x),
+                  Select(cache=shared)(a=x), Select(cache=shared)(b=x)])
+    assert g.run(1) == [2, 101, 2, "a", "b"]
+    assert g.run(1) == [2, 101, 2, "a", "b"]
+    assert (shared.hits, shared.misses) == (5, 5)
+
+    # State which can't be pickled doesn't matter, only the arguments do
+    locked = Locked(cache=LRUCache())(x)
+    g = Graph(x, locked)
+    assert [g.run(1), g.run(1)] == [1, 1]
+    assert (locked.cache.hits, locked.cache.misses) == (1, 1)
+
+    locked = Locked(threading.Lock(), cache=LRUCache())(x)
+    g = Graph(x, locked)
+    with pytest.warns(UserWarning, match="cache key"):
+        assert g.run(1) == 1
+    assert (locked.cache.hits, locked.cache.misses) == (0, 0)
+
+
+def test_lru_eviction():
+    cache = LRUCache(max_entries=2)
+    cache["a"] = 1
+    cache["b"] = 2
+    cache["a"]
+    cache["c"] = 3
+
+    assert cache["a"] == 1
+    assert cache["c"] == 3
+    try:
+        cache["b"]
+        assert False
+    except KeyError:
+        assert cache.misses == 1
+
+    cache = LRUCache(max_bytes=100)
+    cache["small"] = "x"
+    cache["large"] = "x" * 1000
+    assert cache["small"] == "x"
+    assert "large" not in cache._items
+
+
+def test_lru_ttl():
+    cache = LRUCache(ttl=0.05)
+    cache["a"] = 1
+    assert cache["a"] == 1
+
+    time.sleep(0.1)
+    try:
+        cache["a"]
+        assert False
+    except KeyError:
+        assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cache_clone():
+    x = Variable()
+    c = Counted(cache=LRUCache())(x)
+    g = Graph(x, c)
+    g.run("yes")
+
+    gc = deepcopy(g)
+    assert gc.run("yes") == "YES"
+    assert gc.outputs[0].calls == 1
+
+
+def _run_cached(args):
+    path, text = args
+    x = Variable()
+    c = Counted(cache=DiskCache(path))(x)
+    g = Graph(x, c)
+    return g.run(text), c.calls
+
+
+def test_disk_cache(tmp_path):
+    path = str(tmp_path / "cache.db")
+
+    assert _run_cached((path, "yes")) == ("YES", 1)
+    # A fresh node, like after a restart, finds the value on disk
+    assert _run_cached((path, "yes")) == ("YES", 0)
+
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        outputs = list(pool.map(_run_cached, [(path, t) for t in ["yes", "no", "no", "yes"]]))
+
+    assert [o for o, _ in outputs] == ["YES", "NO", "NO", "YES"]
+    assert sum(calls for _, calls in outputs) <= 2
+
+    # Different nodes on the same file don't read each other's values
+    x = Variable()
+    g = Graph(x, [Counted(cache=DiskCache(path))(x), Lower(cache=DiskCache(path))(x)])
+    assert g.run("Yes") == ["YES", "yes"]
+
+    cache = DiskCache(path, namespace="other", ttl=0.05)
+    cache["a"] = 1
+    assert cache["a"] == 1
+    time.sleep(0.1)
+    try:
+        cache["a"]
+        assert False
+    except KeyError:
+        assert (cache.hits, cache.misses) == (1, 1)
+
+
+_SEARCH_SCRIPT = """
+import sys
+from lute.graph import Graph
+from lute.node import Variable
+from lute.node.cache import DiskCache
+from lute.node.search import FuzzySearch, ListSearch
+
+x = Variable()
+searches = [
+    ListSearch(["new york", "york", "blue moon"], engine="combined", cache=DiskCache(sys.argv[1]))(x),
+    FuzzySearch(["new york", "venus", "blue moon"], cache=DiskCache(sys.argv[1]))(x)
+]
+Graph(x, searches).run("new yrok and the blue moon")
+print(sum(s.cache.misses for s in searches), sum(s.cache.hits for s in searches))
+"""
+
+
+def test_disk_cache_processes(tmp_path):
+    path = str(tmp_path / "cache.db")
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    counts = []
+    for seed in ["1", "2"]:
+        env = {**os.environ, "PYTHONHASHSEED": seed, "PYTHONPATH": root}
+        out = subprocess.run([sys.executable, "-c", _SEARCH_SCRIPT, path], env=env, check=True,
+                             stdout=subprocess.PIPE, universal_newlines=True).stdout
+        counts.append(out.split())
+
+    # Keys don't depend on the hash seed so the second process finds everything
+    assert counts == [["2", "0"], ["0", "2"]]
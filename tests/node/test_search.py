@@ -1,8 +1,12 @@
+import random
+
 import pytest
 from lute.graph import Graph
 from lute.node import Variable
 from lute.node.fn import node_fn
-from lute.node.search.constraint import ConstraintSearch
+from lute.node.search import FuzzySearch, fuzzy
+from lute.node.search.constraint import ConstraintSearch, RankConstraints
+from lute.node.search.fuzzy import edit_distance
 from lute.node.search.generic import Canonicalize, ExpansionSearch, ListSearch
 
 
@@ -140,6 +144,63 @@ def test_expansion_regex_hi():
     }]
 
 
+def test_expansion_combined():
+    def make_exp():
+        return {
+            "hello": ["hola", "hello", "hey there", "hey"],
+            "world": ["planet earth", "planet venus kek", "world", "earth"],
+            "planet": ["planet", "mars"]
+        }
+
+    terms = ["hello", "world", "planet"]
+    texts = [
+        "Hello world",
+        "hola planet earth",
+        "hey there planet venus kek world, earth and hello",
+        "lol planet mars",
+        "planetearth hellohola",
+        ""
+    ]
+
+    search = node_fn(ExpansionSearch(terms, make_exp(), regex=False))
+    combined = node_fn(ExpansionSearch(terms, make_exp(), regex=False, engine="combined"))
+
+    for text in texts:
+        assert combined(text) == search(text)
+    assert {r["value"]: r["range"] for r in combined("planet earth")} == {"world": (0, 12), "planet": (0, 6)}
+
+    exp_hi = {
+        "card": ["कार्ड", "कॉर्ड"],
+        "lost": ["खो", "गुम", "गायब", "लुप्त"]
+    }
+    search = node_fn(ExpansionSearch(["card", "lost"], dict(exp_hi), lang="hi", regex=False))
+    combined = node_fn(ExpansionSearch(["card", "lost"], dict(exp_hi), lang="hi", regex=False, engine="combined"))
+    assert combined("कार्ड खो गया है") == search("कार्ड खो गया है")
+
+    fn = node_fn(ListSearch(["Blue moon", "venus", "f*ck"], engine="combined"))
+    assert fn("what the f*ck is a blue moon?") == [
+        {"type": "list", "value": "Blue moon", "range": (19, 28)},
+        {"type": "list", "value": "f*ck", "range": (9, 13)}
+    ]
+
+    # Phrases sharing prefixes and suffixes, as the automaton follows failure links
+    rng = random.Random(0)
+    words = ["new", "york", "city", "o'neil", "a", "an", "ana", "banana", "c++"]
+    for _ in range(20):
+        items = list({" ".join(rng.choices(words, k=rng.randint(1, 3))) for _ in range(8)})
+        search = node_fn(ListSearch(items))
+        combined = node_fn(ListSearch(items, engine="combined"))
+        for _ in range(10):
+            text = " ".join(rng.choices(words + ["bananas", "New-York", "x"], k=15))
+            assert combined(text) == search(text)
+
+    with pytest.raises(ValueError):
+        ExpansionSearch(terms, make_exp(), engine="combined")
+
+    with pytest.raises(ValueError):
+        ExpansionSearch(terms, make_exp(), engine="lol")
+
+
 def test_canonicalization():
     exp = {
         "hello": ["hola", "hello", "hey"],
@@ -177,6 +238,53 @@ def test_canonicalization_dup():
     assert g.run("hey planet earth universe world") == "hello world"
 
 
+def _canonicalize_reference(text, searches, remove_duplicates):
+    """
+    Pairwise overlap checks and splicing, like Canonicalize used to do.
+    """
+
+    def _overlap_p(res1, res2):
+        first, second = (res1, res2) if res1["range"][0] < res2["range"][0] else (res2, res1)
+        return first["range"][1] >= second["range"][0]
+
+    filtered = []
+    matched = set()
+    for it in sorted(searches, key=lambda res: res["range"][1] - res["range"][0], reverse=True):
+        if remove_duplicates and it["value"] in matched:
+            filtered.append({**it, "value": ""})
+        elif not any(_overlap_p(it, fit) for fit in filtered):
+            matched.add(it["value"])
+            filtered.append(it)
+
+    offset = 0
+    chars = list(text)
+    for search in sorted(filtered, key=lambda res: res["range"][0]):
+        rng = search["range"]
+        chars[rng[0] - offset:rng[1] - offset] = list(search["value"])
+        offset += (rng[1] - rng[0]) - len(search["value"])
+
+    return " ".join("".join(chars).split())
+
+
+def test_canonicalization_many():
+    rng = random.Random(0)
+    text = " ".join(rng.choice(["hola", "planet", "earth", "world", "x"]) for _ in range(4000))
+
+    searches = []
+    for _ in range(5000):
+        start = rng.randrange(len(text) - 20)
+        searches.append({
+            "type": "expansion",
+            "value": rng.choice(["hello", "world", "planet"]),
+            "range": (start, start + rng.randrange(1, 20))
+        })
+
+    for remove_duplicates in [False, True]:
+        fn = node_fn(Canonicalize(remove_duplicates=remove_duplicates))
+        assert fn(text, searches) == _canonicalize_reference(text, searches, remove_duplicates)
+        assert fn(text, searches[:50]) == _canonicalize_reference(text, searches[:50], remove_duplicates)
+
+
 def test_list():
     terms = [
         "Blue moon",
@@ -206,6 +314,183 @@ def test_list_regex():
     assert fn("what the f*ck!") == [{"type": "list", "value": terms[1], "range": (9, 13)}]
 
 
+def test_list_trie():
+    terms = [
+        "New York",
+        "new york city",
+        "York",
+        "ha ha",
+        "f*ck",
+        "Hello - world",
+        "कार्ड",
+        "card"
+    ]
+
+    texts = [
+        "I love New York city, new YORK!",
+        "ha ha ha ha ha",
+        "what the f*ck, Hello - world",
+        "कार्ड खो गया, card lost, cards",
+        "Newyork"
+    ]
+
+    search = node_fn(ListSearch(terms))
+    trie = node_fn(ListSearch(terms, engine="trie"))
+
+    for text in texts:
+        assert trie(text) == search(text)
+
+    with pytest.raises(ValueError):
+        ExpansionSearch(["hello"], {"hello": ["hell?o"]}, engine="trie")
+
+
+def test_list_token():
+    terms = [
+        "New York",
+        "new york city",
+        "York",
+        "ha ha",
+        "कार्ड",
+        "card"
+    ]
+
+    texts = [
+        "I love New York city, new YORK!",
+        "ha ha ha ha ha",
+        "कार्ड खो गया, card lost, cards",
+        "Newyork"
+    ]
+
+    search = node_fn(ListSearch(terms))
+    token = node_fn(ListSearch(terms, engine="token"))
+
+    for text in texts:
+        assert token(text) == search(text)
+
+    # Only the tokens are compared
+    assert token("new-york  city") == [
+        {"type": "list", "value": "New York", "range": (0, 8)},
+        {"type": "list", "value": "new york city", "range": (0, 14)},
+        {"type": "list", "value": "York", "range": (4, 8)}
+    ]
+
+    c = Canonicalize()
+    fn = node_fn(c)
+    assert fn("i love new york city", token("i love new york city")) == "i love new york city"
+
+    # Forms not covered by their tokens are skipped instead of matching a part
+    with pytest.warns(UserWarning, match="c\\+\\+"):
+        token = node_fn(ListSearch(["c++", "c", "node.js"], engine="token"))
+    text = "c++ or c, not node.js"
+    assert token(text) == [
+        {"type": "list", "value": "c", "range": (0, 1)},
+        {"type": "list", "value": "c", "range": (7, 8)},
+        {"type": "list", "value": "node.js", "range": (14, 21)}
+    ]
+    assert token(text) == node_fn(ListSearch(["c++", "c", "node.js"]))(text)
+    assert fn(text, token(text)) == text
+
+
+def test_fuzzy():
+    terms = ["New York", "Bengaluru", "Mumbai", "Goa", "कोलकाता"]
+    fn = node_fn(FuzzySearch(terms))
+
+    assert fn("flight from new yrok to bangaluru") == [{
+        "type": "fuzzy",
+        "value": "New York",
+        "range": (12, 20),
+        "distance": 1
+    }, {
+        "type": "fuzzy",
+        "value": "Bengaluru",
+        "range": (24, 33),
+        "distance": 1
+    }]
+    assert fn("newyork, GOA and mumbai") == [
+        {"type": "fuzzy", "value": "New York", "range": (0, 7), "distance": 1},
+        {"type": "fuzzy", "value": "Mumbai", "range": (17, 23), "distance": 0},
+        {"type": "fuzzy", "value": "Goa", "range": (9, 12), "distance": 0}
+    ]
+    # Short terms only match exactly
+    assert fn("go to boa") == []
+    assert [r["value"] for r in fn("कोलकता जाना है")] == ["कोलकाता"]
+
+    fn = node_fn(FuzzySearch(terms, max_distance=2))
+    assert [(r["value"], r["distance"]) for r in fn("to bangalru")] == [("Bengaluru", 2)]
+
+
+def test_fuzzy_large(monkeypatch):
+    rng = random.Random(0)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    terms = ["".join(rng.choices(letters, k=8)) for _ in range(20000)]
+
+    search = FuzzySearch(terms)
+    fn = node_fn(search)
+    text = " ".join(term[:3] + term[4:] for term in terms[:200])
+
+    compared = []
+
+    def _edit_distance(a, b, max_distance):
+        compared.append(b)
+        return edit_distance(a, b, max_distance)
+
+    monkeypatch.setattr(fuzzy, "edit_distance", _edit_distance)
+    results = fn(text)
+
+    assert {r["value"] for r in results} >= set(terms[:200])
+    # Only the terms sharing a deleted form with a phrase are compared
+    assert len(compared) <= 2 * 200
+
+
+def test_search_batch():
+    terms = ["New York", "new york city", "ha ha", "f*ck", "कार्ड"]
+    texts = [
+        "I love New York city",
+        "",
+        "ha ha ha ha ha",
+        "new",
+        "york, f*ck",
+        "कार्ड खो गया"
+    ]
+
+    for engine in ["term", "combined", "trie", "token"]:
+        x = Variable()
+        g = Graph(x, ListSearch(terms, engine=engine)(x))
+        assert g.run_batch(texts) == [g.run(text) for text in texts]
+
+    exp = {
+        "hello": ["hola", "hell?o", "hey!?( there)?"],
+        "world": ["planet( earth| venus| kek)+", "world"]
+    }
+    x = Variable()
+    g = Graph(x, ExpansionSearch(["hello", "world"], exp)(x))
+    assert g.run_batch(texts + ["hey there planet earth"]) == [g.run(text) for text in texts + ["hey there planet earth"]]
+
+
+def test_search_artifacts(tmp_path, monkeypatch):
+    terms = ["New York", "venus", "f*ck"]
+    text = "what the f*ck is in new york"
+
+    for engine in ["term", "combined", "trie", "token"]:
+        search = ListSearch(terms, engine=engine, artifact_dir=str(tmp_path / engine))
+        expected = node_fn(search)(text)
+        assert len(list((tmp_path / engine).glob("matcher-*.pkl"))) == 1
+
+        with monkeypatch.context() as m:
+            m.setattr(ListSearch, "_prepare_matcher", lambda self: pytest.fail("matcher rebuilt"))
+            assert node_fn(ListSearch(terms, engine=engine, artifact_dir=str(tmp_path / engine)))(text) == expected
+
+    # Different terms get their own artifact
+    ListSearch(terms[:2], engine="trie", artifact_dir=str(tmp_path / "trie"))
+    artifacts = list((tmp_path / "trie").glob("matcher-*.pkl"))
+    assert len(artifacts) == 2
+
+    # Broken artifacts are rebuilt
+    for path in artifacts:
+        path.write_bytes(b"lol")
+    assert node_fn(ListSearch(terms, engine="trie", artifact_dir=str(tmp_path / "trie")))(text) == expected
+
+
 def test_constraints_partial():
     constraints = [
         {"name": "1", "items": {"first": "moon", "second": "moon"}},
@@ -282,3 +567,88 @@ def test_constraints_complete():
            ]
     assert g.run(values_dict={x1: [{"type": "search_type", "value": "lol"}],
                               x2: [{"type": "search_type", "value": "lel"}]}) == []
+
+    # Repeated values are counted once, even along with unhashable ones
+    values = [{"type": "search_type", "value": v} for v in ["kek", "kek", ["x"]]]
+    assert [it["name"] for it in g.run(values_dict={x1: [], x2: values})] == ["2"]
+
+
+def test_constraints_many():
+    rng = random.Random(0)
+    keys = ["first", "second", "third"]
+    words = ["moon", "kek", "lol", "lel", "venus"]
+
+    constraints = []
+    for idx in range(2000):
+        items = {key: rng.choice(words + [None]) for key in rng.sample(keys, rng.randint(1, 3))}
+        constraints.append({"name": str(idx), "items": items})
+
+    def _reference(input_values, partial):
+        results = []
+        for c in constraints:
+            missing = [key for key, value in c["items"].items()
+                       if value is not None and value not in input_values[key]]
+            results.append({
+                "type": "constraint",
+                "name": c["name"],
+                "constraint": c["items"],
+                "missing": missing,
+                "score": 1 - (len(missing) / len(c["items"]))
+            })
+
+        results = sorted(results, key=lambda c: c["score"], reverse=True)
+        if partial:
+            return [it for it in results if len(it["missing"]) < len(it["constraint"])]
+        else:
+            return [it for it in results if len(it["missing"]) == 0]
+
+    xs = {key: Variable() for key in keys}
+    for partial in [False, True]:
+        g = Graph(list(xs.values()), ConstraintSearch(constraints, partial=partial)(xs))
+        g_top = Graph(list(xs.values()), ConstraintSearch(constraints, partial=partial, top_k=5)(xs))
+
+        for _ in range(20):
+            input_values = {key: rng.sample(words, rng.randint(0, 2)) for key in keys}
+            values_dict = {xs[key]: [{"type": "search_type", "value": value} for value in values]
+                           for key, values in input_values.items()}
+
+            expected = _reference(input_values, partial)
+            assert g.run(values_dict=values_dict) == expected
+            assert g_top.run(values_dict=values_dict) == expected[:5]
+
+
+def test_rank_constraints():
+    constraints = [
+        {"name": "1", "items": {"first": "moon", "second": "moon"}},
+        {"name": "2", "items": {"second": "kek"}},
+        {"name": "3", "items": {"first": "lol", "second": "kek"}},
+        {"name": "4", "items": {"first": "lel", "second": "kek"}},
+        {"name": "5", "items": {"first": "lol", "second": "venus"}}
+    ]
+
+    x1 = Variable()
+    x2 = Variable()
+    c = ConstraintSearch(constraints, partial=True)({"first": x1, "second": x2})
+
+    g = Graph([x1, x2], RankConstraints()(c))
+    g_pre = Graph([x1, x2], RankConstraints(constraints)(c))
+
+    # Same weights when all the constraints are matched
+    values_dict = {x1: [{"type": "search_type", "value": value} for value in ["moon", "lol", "lel"]],
+                   x2: [{"type": "search_type", "value": value} for value in ["moon", "kek", "venus"]]}
+    ranked = g.run(values_dict=values_dict)
+    assert len(ranked) == 5
+    assert g_pre.run(values_dict=values_dict) == ranked
+
+    values_dict = {x1: [{"type": "search_type", "value": "lol"}], x2: [{"type": "search_type", "value": "kek"}]}
+    assert [it["name"] for it in g_pre.run(values_dict=values_dict)] == ["3", "2", "5", "4"]
+    assert g_pre.run(values_dict={x1: [], x2: []}) == []
+
+    # Items without a value don't go in the documents
+    constraints.append({"name": "6", "items": {"first": "lol", "second": None}})
+    c = ConstraintSearch(constraints, partial=True)({"first": x1, "second": x2})
+    g = Graph([x1, x2], RankConstraints()(c))
+    g_pre = Graph([x1, x2], RankConstraints(constraints)(c))
+    ranked = g.run(values_dict=values_dict)
+    assert "6" in [it["name"] for it in ranked]
+    assert g_pre.run(values_dict=values_dict) == ranked